@@ -3,22 +3,637 @@ import pickle
 import re
 import csv
 import argparse
-from datetime import datetime
+import asyncio
+import hashlib
+import json
+import mmap
+import queue
+import random
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from heapq import merge
+from itertools import chain
 from pathlib import Path
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
+import email.errors
+import email.header
 import email.utils
+import functools
+import unicodedata
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # Configuration constants
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 BATCH_SIZE = 1000
+BATCH_REQUEST_LIMIT = 100  # Gmail batch endpoint accepts at most 100 calls
+BATCH_MAX_RETRIES = 3
+GMAIL_API_ROOT = 'https://gmail.googleapis.com/gmail/v1'
+ASYNC_MAX_IN_FLIGHT = 100
+FETCH_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_MAX = 60.0
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+SHARD_TARGET_MESSAGES = 10000  # Split date windows estimated to hold more
+SHARD_MIN_SECONDS = 86400
+SHARD_LISTERS = 4
+GMAIL_LAUNCH_DATE = '2004-04-01'
+PIPELINE_QUEUE_SIZE = 1000  # Bounded stage queues keep memory flat
+BATCH_FILL_TIMEOUT = 0.05
+PARSE_PAGE_SIZE = 500  # Messages whose senders are parsed and aggregated together
+SENDER_MEMO_SIZE = 10000
+SENDER_MEMO_FILENAME = 'sender_memo.json'
+SENDER_PARSER_VERSION = 2  # Bump when parsing changes, to drop saved memo entries
+DISPLAY_NAME_CACHE_SIZE = 10000
+PUBLIC_SUFFIX_FILENAME = 'public_suffix_list.dat'  # Bundled snapshot, next to this script
+DOMAIN_CACHE_SIZE = 10000
+QUOTA_UNITS_PER_SECOND = 250  # Gmail per-user rate limit
+# Headers and partial-response fields the sender analysis and fact store
+# read; enabled analyzers add theirs (see MetadataRequest)
+METADATA_HEADERS = ['From']
+MESSAGE_FIELDS = ['internalDate', 'sizeEstimate', 'labelIds', 'payload/headers(name,value)']
+EMAIL_PATTERN = re.compile(r'^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}$', re.IGNORECASE)
+ADDRESS_PATTERN = r'[^\s"\\()<>@,;:\[\]]+@[^\s"\\()<>@,;:\[\]]+'
+SENDER_PATTERN = re.compile(rf"""
+    \s*(?:
+        (?:"(?P<quoted>[^"\\]*)"|(?P<name>[^"\\()<>@,;:\[\]]*))\s*<(?P<address>{ADDRESS_PATTERN})>
+        |(?P<bare>{ADDRESS_PATTERN})
+    )\s*
+""", re.VERBOSE)
+BASE64_WORD_PATTERN = re.compile(r'=\?[^?]*\?b\?', re.IGNORECASE)
+LIST_ID_PATTERN = re.compile(r'<([^<>]+)>')
+SUBJECT_PREFIX_PATTERN = re.compile(r'\s*(re|fwd?|aw|wg|sv|tr)\s*(?:\[\d+\])?\s*:|\s*\[[^\]]*\]',
+                                    re.IGNORECASE)
+LIST_FIELDS = 'messages(id),nextPageToken'
+THREAD_LIST_FIELDS = 'threads(id,historyId),nextPageToken'
+ESTIMATE_FIELDS = 'messages(id),resultSizeEstimate'
+HISTORY_FIELDS = 'history/messagesAdded/message/id,historyId,nextPageToken'
+PROFILE_FIELDS = 'historyId'
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'threads.list': 10,
+    'threads.get': 10,
+    'history.list': 2,
+    'getProfile': 1,
+}
 CSV_FILENAME = 'email_analysis.csv'
 
-PICKLE_FILENAME = 'processed_ids.pickle'
+PICKLE_FILENAME = 'processed_ids.pickle'  # Legacy format, migrated on load
+IDS_FILENAME = 'processed_ids.bin'
+IDS_MAGIC = b'GMID'
+IDS_VERSION = 1
+IDS_HEADER = struct.Struct('<4sHxxQ')  # magic, version, count
+IDS_SIDECAR_FILENAME = 'processed_ids.new'
+IDS_SIDECAR_LIMIT = 100000  # Sidecar entries that trigger compaction
+IDS_WRITE_CHUNK = 65536
+WAL_FILENAME = 'email_analysis.wal'
+CHECKPOINT_FILENAME = 'email_analysis.checkpoint'
+WAL_SYNC_RECORDS = 1000  # Records per fsync of the log
+WAL_COMPACT_MIN = 10000  # Log records before folding into the CSV snapshot
+DB_FILENAME = 'email_analysis.db'
+DB_COMMIT_RECORDS = 500  # One listing page of results per transaction
+FACTS_DIR = 'facts'
+FACT_COLUMNS = (  # name, array typecode
+    ('msg_id', 'Q'),
+    ('sender', 'I'),
+    ('internal_date', 'q'),  # ms since the epoch
+    ('size_estimate', 'I'),
+    ('labels', 'Q'),
+)
+FACT_SENDERS_FILENAME = 'senders.jsonl'
+FACT_LABELS_FILENAME = 'labels.json'
+FACTS_FLUSH_ROWS = 1000
+LABEL_BITS = 64
+CACHE_DIR = 'message_cache'
+CACHE_MAGIC = b'GMCB'
+CACHE_BLOCK_HEADER = struct.Struct('<4sII')  # magic, metadata length, data length
+CACHE_BLOCK_MESSAGES = 100
+CACHE_SEGMENT_BYTES = 64 * 1024 * 1024
+CACHE_MAX_MB = 512
+CACHE_INDEX_FILENAME = 'index.bin'
+CACHE_INDEX_MAGIC = b'GMCI'
+CACHE_INDEX_VERSION = 1
+CACHE_INDEX_HEADER = struct.Struct('<4sHxxQI')  # magic, version, entry count, metadata length
+CACHE_INDEX_PENDING_LIMIT = 100000  # Messages indexed in memory before index.bin is rebuilt
+FAILED_FILENAME = 'failed_ids.pickle'
+FAILED_THREADS_FILENAME = 'failed_thread_ids.pickle'  # Retried with threads.get
+SYNC_STATE_FILENAME = 'sync_state.pickle'
+
+class QuotaLimiter:
+    """Thread-safe token bucket measured in Gmail API quota units."""
+
+    def __init__(self, units_per_second=QUOTA_UNITS_PER_SECOND):
+        self.lock = threading.Lock()
+        self.consumed = 0
+        self.configure(units_per_second)
+
+    def configure(self, units_per_second):
+        """Set the sustained budget; 0 disables throttling but keeps counting."""
+        with self.lock:
+            self.rate = units_per_second
+            self.tokens = units_per_second
+            self.updated = time.monotonic()
+
+    def reserve(self, method, count=1):
+        """Charge count calls of method and return how many seconds to wait before sending."""
+        units = QUOTA_UNITS[method] * count
+        with self.lock:
+            self.consumed += units
+            if self.rate <= 0:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= units
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, method, count=1):
+        """Block until count calls of method fit in the budget."""
+        delay = self.reserve(method, count)
+        if delay:
+            time.sleep(delay)
+
+quota_limiter = QuotaLimiter()
+
+class MessageCache:
+    """Compressed on-disk cache of metadata responses keyed by message ID.
+
+    Responses are appended in zlib-compressed blocks of CACHE_BLOCK_MESSAGES
+    to segment files in CACHE_DIR. Each block starts with an uncompressed
+    header naming its message IDs, headers and fields. Once the cache
+    outgrows its size cap the oldest segments are deleted first. Disabled
+    until configured.
+
+    index.bin lists cached message IDs sorted, each with its block's
+    segment, offset and header/field signature, in three packed columns.
+    It is memory-mapped and searched with bisect like the processed IDs,
+    so opening the cache reads no blocks and holds no per-message objects.
+    Blocks written after the index was built are indexed in memory, found
+    on startup by reading just their block headers, and folded into a new
+    index once they hold CACHE_INDEX_PENDING_LIMIT messages.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.hits = 0
+        self.mm = None
+
+    def configure(self, max_bytes, headers=None, fields=None, path=CACHE_DIR):
+        """Open the cache; responses fetched without these headers or fields count as misses."""
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.close_index()
+        self.headers = sorted(headers or metadata_request.headers)
+        self.fields = sorted(fields or metadata_request.fields)
+        self.enabled = max_bytes > 0
+        self.recent = {}
+        self.unindexed = []
+        self.segments = []
+        self.pending = {}
+        self.block = (None, {})
+        self.signatures = []
+        self.signature_ids = {}
+        self.usable = []
+        self.keys = self.locations = self.slots = ()
+        if not self.enabled:
+            return
+        self.path.mkdir(exist_ok=True)
+        self.segment_bytes = min(CACHE_SEGMENT_BYTES, max(max_bytes // 4, 1))
+        self.segments = sorted(self.path.glob('*.seg'))
+        covered = self.open_index()
+        covered_segment, covered_offset = covered or (0, 0)
+        for segment in self.segments:
+            if int(segment.stem) > covered_segment:
+                self.scan(segment, 0)
+            elif int(segment.stem) == covered_segment:
+                self.scan(segment, covered_offset)
+        if not self.segments:
+            self.segments.append(self.path / f"{1:08d}.seg")
+        if covered is None or len(self.unindexed) >= CACHE_INDEX_PENDING_LIMIT:
+            self.rebuild_index()
+
+    def segment_path(self, segment_no):
+        return self.path / f"{segment_no:08d}.seg"
+
+    def open_index(self):
+        """Map index.bin and return the (segment, offset) up to which it covers the blocks.
+
+        Returns None if the index is missing or unusable.
+        """
+        index_path = self.path / CACHE_INDEX_FILENAME
+        if not index_path.exists():
+            return None
+        try:
+            with open(index_path, 'rb') as f:
+                header = f.read(CACHE_INDEX_HEADER.size)
+                if len(header) != CACHE_INDEX_HEADER.size:
+                    raise ValueError("truncated header")
+                magic, version, count, meta_len = CACHE_INDEX_HEADER.unpack(header)
+                if magic != CACHE_INDEX_MAGIC or version != CACHE_INDEX_VERSION:
+                    raise ValueError(f"unsupported format {magic!r} v{version}")
+                meta = json.loads(f.read(meta_len))
+                start = CACHE_INDEX_HEADER.size + meta_len
+                if os.fstat(f.fileno()).st_size != start + count * 18:
+                    raise ValueError("length does not match header")
+                covered_segment, covered_offset = meta['covered']
+                covered_path = self.segment_path(covered_segment)
+                if covered_path.exists() and covered_path.stat().st_size < covered_offset:
+                    raise ValueError("segments changed since the index was written")
+                for headers, fields in meta['signatures']:
+                    self.signature(headers, fields)
+                if sys.byteorder != 'little':
+                    self.keys = array('Q', f.read(count * 8))
+                    self.locations = array('Q', f.read(count * 8))
+                    self.slots = array('H', f.read(count * 2))
+                    for column in (self.keys, self.locations, self.slots):
+                        column.byteswap()
+                    return covered_segment, covered_offset
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (KeyError, TypeError, ValueError) as error:
+            print(f"Corrupted {index_path} ({error}), rebuilding it from the blocks...")
+            self.signatures, self.signature_ids, self.usable = [], {}, []
+            return None
+        view = memoryview(self.mm)
+        self.keys = view[start:start + count * 8].cast('Q')
+        self.locations = view[start + count * 8:start + count * 16].cast('Q')
+        self.slots = view[start + count * 16:start + count * 18].cast('H')
+        view.release()
+        return covered_segment, covered_offset
+
+    def close_index(self):
+        """Release the mapping of index.bin."""
+        if self.mm is not None:
+            for column in (self.keys, self.locations, self.slots):
+                column.release()
+            self.mm.close()
+            self.mm = None
+        self.keys = self.locations = self.slots = ()
+
+    def signature(self, headers, fields):
+        """Return the number of a block's headers and fields, or None once 256 are in use."""
+        # Blocks without a field list hold complete responses
+        key = json.dumps([sorted(headers), None if fields is None else sorted(fields)])
+        signature = self.signature_ids.get(key)
+        if signature is None:
+            if len(self.signatures) > 0xFF:
+                return None
+            signature = self.signature_ids[key] = len(self.signatures)
+            self.signatures.append(json.loads(key))
+            self.usable.append(set(self.headers) <= set(headers)
+                               and (fields is None or set(self.fields) <= set(fields)))
+        return signature
+
+    def scan(self, segment, offset):
+        """Index the blocks of a segment from offset on, cutting off a torn final block.
+
+        Only block headers are read; the compressed data is skipped.
+        """
+        with open(segment, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while offset < size:
+                try:
+                    magic, meta_len, data_len = CACHE_BLOCK_HEADER.unpack(
+                        f.read(CACHE_BLOCK_HEADER.size))
+                    if magic != CACHE_MAGIC:
+                        raise ValueError(f"bad magic {magic!r}")
+                    end = offset + CACHE_BLOCK_HEADER.size + meta_len + data_len
+                    if end > size:
+                        raise ValueError("truncated block")
+                    meta = json.loads(f.read(meta_len))
+                except (struct.error, ValueError):
+                    print(f"Ignoring torn block at the end of {segment}")
+                    break
+                self.add_block(int(segment.stem), offset, meta)
+                offset = end
+                f.seek(offset)
+        if offset < size:
+            os.truncate(segment, offset)
+
+    def add_block(self, segment_no, offset, meta):
+        signature = self.signature(meta['headers'], meta.get('fields'))
+        if signature is None:
+            return
+        location = segment_no << 32 | offset
+        for position, msg_id in enumerate(meta['ids']):
+            self.unindexed.append((int(msg_id, 16), location, signature << 8 | position))
+            if self.usable[signature]:
+                self.recent[msg_id] = (segment_no, offset, position)
+
+    def find(self, msg_id):
+        """Return the (segment, offset, position) of msg_id's newest usable copy in the index."""
+        try:
+            value = int(msg_id, 16)
+        except ValueError:
+            return None
+        first_segment = int(self.segments[0].stem)
+        # Among equal IDs the newest block sorts last
+        index = bisect_right(self.keys, value) - 1
+        while index >= 0 and self.keys[index] == value:
+            location, slot = self.locations[index], self.slots[index]
+            if location >> 32 >= first_segment and self.usable[slot >> 8]:
+                return location >> 32, location & 0xFFFFFFFF, slot & 0xFF
+            index -= 1
+        return None
+
+    def rebuild_index(self):
+        """Fold the blocks indexed in memory into a new index.bin, dropping evicted segments."""
+        first_segment = int(self.segments[0].stem)
+        keys, locations, slots = array('Q'), array('Q'), array('H')
+        for key, location, slot in merge(zip(self.keys, self.locations, self.slots),
+                                         sorted(self.unindexed)):
+            if location >> 32 >= first_segment:
+                keys.append(key)
+                locations.append(location)
+                slots.append(slot)
+        last = self.segments[-1]
+        covered = [int(last.stem), last.stat().st_size if last.exists() else 0]
+        meta = json.dumps({'covered': covered, 'signatures': self.signatures}).encode()
+        # Pad so the ID column starts 8-byte aligned
+        meta += b' ' * (-(CACHE_INDEX_HEADER.size + len(meta)) % 8)
+        if sys.byteorder != 'little':
+            for column in (keys, locations, slots):
+                column.byteswap()
+        index_path = self.path / CACHE_INDEX_FILENAME
+        with open(f"{index_path}.tmp", 'wb') as f:
+            f.write(CACHE_INDEX_HEADER.pack(CACHE_INDEX_MAGIC, CACHE_INDEX_VERSION,
+                                            len(keys), len(meta)))
+            f.write(meta)
+            for column in (keys, locations, slots):
+                f.write(column.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.close_index()
+        os.replace(f"{index_path}.tmp", index_path)
+        self.recent = {}
+        self.unindexed = []
+        self.open_index()
+
+    def __len__(self):
+        return len(self.ids())
+
+    def ids(self):
+        """Return the usable cached message IDs, without duplicates."""
+        with self.lock:
+            first_segment = int(self.segments[0].stem) if self.segments else 0
+            indexed = (format(key, 'x') for key, location, slot
+                       in zip(self.keys, self.locations, self.slots)
+                       if location >> 32 >= first_segment and self.usable[slot >> 8])
+            return list(dict.fromkeys(chain(indexed, self.recent, self.pending)))
+
+    def get(self, msg_id):
+        """Return the cached response for msg_id, or None."""
+        if not self.enabled:
+            return None
+        with self.lock:
+            message = self.pending.get(msg_id)
+            if message is None:
+                location = self.recent.get(msg_id) or self.find(msg_id)
+                if location is not None:
+                    segment_no, offset, position = location
+                    if self.block[0] != (segment_no, offset):
+                        self.block = ((segment_no, offset), self.read_block(segment_no, offset))
+                    message = self.block[1][position]
+            if message is not None:
+                self.hits += 1
+            return message
+
+    def read_block(self, segment_no, offset):
+        with open(self.segment_path(segment_no), 'rb') as f:
+            f.seek(offset)
+            _, meta_len, data_len = CACHE_BLOCK_HEADER.unpack(f.read(CACHE_BLOCK_HEADER.size))
+            f.seek(meta_len, os.SEEK_CUR)
+            return json.loads(zlib.decompress(f.read(data_len)))
+
+    def put(self, msg_id, message):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.pending[msg_id] = message
+            if len(self.pending) >= CACHE_BLOCK_MESSAGES:
+                self.write_block()
+
+    def write_block(self):
+        ids = list(self.pending)
+        meta = {'ids': ids, 'headers': self.headers, 'fields': self.fields}
+        data = zlib.compress(json.dumps([self.pending[msg_id] for msg_id in ids]).encode())
+        meta_bytes = json.dumps(meta).encode()
+        segment = self.segments[-1]
+        with open(segment, 'ab') as f:
+            offset = f.tell()
+            f.write(CACHE_BLOCK_HEADER.pack(CACHE_MAGIC, len(meta_bytes), len(data)))
+            f.write(meta_bytes)
+            f.write(data)
+        self.add_block(int(segment.stem), offset, meta)
+        self.pending = {}
+        if segment.stat().st_size >= self.segment_bytes:
+            self.segments.append(self.path / f"{int(segment.stem) + 1:08d}.seg")
+            self.evict()
+        if len(self.unindexed) >= CACHE_INDEX_PENDING_LIMIT:
+            self.rebuild_index()
+
+    def evict(self):
+        """Delete the oldest segments until the cache fits its size cap.
+
+        Index entries of deleted segments are skipped until the next rebuild.
+        """
+        total = sum(segment.stat().st_size for segment in self.segments[:-1])
+        while len(self.segments) > 1 and total > self.max_bytes:
+            oldest = self.segments.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink()
+            oldest_no = int(oldest.stem)
+            self.recent = {msg_id: location for msg_id, location in self.recent.items()
+                           if location[0] != oldest_no}
+            self.unindexed = [entry for entry in self.unindexed if entry[1] >> 32 != oldest_no]
+            self.block = (None, {})
+
+    def close(self):
+        """Write the last partial block."""
+        if self.enabled:
+            with self.lock:
+                if self.pending:
+                    self.write_block()
+
+message_cache = MessageCache()
+
+class MetadataRequest:
+    """Headers and fields messages.get asks for: the union of what analyzers need."""
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, analyzers=()):
+        self.headers = sorted(set(METADATA_HEADERS).union(*(a.headers for a in analyzers)))
+        self.fields = sorted(set(MESSAGE_FIELDS).union(*(a.fields for a in analyzers)))
+        self.field_mask = ','.join(self.fields)
+
+metadata_request = MetadataRequest()
+
+class GmailApiError(Exception):
+    """HTTP error returned by the Gmail REST API outside of googleapiclient."""
+
+    def __init__(self, status, content, headers=None):
+        super().__init__(f"HTTP {status}: {content[:200]}")
+        self.status = status
+        self.content = content
+        self.headers = headers or {}
+
+def parse_error_reasons(content):
+    """Return the reason codes listed in a Gmail JSON error body."""
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        errors = json.loads(content).get('error', {}).get('errors', [])
+        return {e.get('reason') for e in errors}
+    except (ValueError, AttributeError):
+        return set()
+
+def parse_retry_after(value):
+    """Convert a Retry-After header (seconds or HTTP date) to seconds."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error):
+    """Classify an API error as 'throttled', 'transient' or 'permanent'.
+
+    Returns (kind, retry_after) where retry_after is the server-requested
+    delay in seconds, if any.
+    """
+    if isinstance(error, HttpError):
+        status, headers, content = error.resp.status, error.resp, error.content
+    elif isinstance(error, GmailApiError):
+        status, headers, content = error.status, error.headers, error.content
+    elif isinstance(error, (OSError, httplib2.HttpLib2Error, asyncio.TimeoutError)):
+        return 'transient', None
+    elif aiohttp is not None and isinstance(error, aiohttp.ClientError):
+        return 'transient', None
+    else:
+        return 'permanent', None
+
+    retry_after = parse_retry_after(headers.get('retry-after'))
+    if status == 429 or (status == 403 and parse_error_reasons(content) & RATE_LIMIT_REASONS):
+        return 'throttled', retry_after
+    if status >= 500:
+        return 'transient', retry_after
+    return 'permanent', None
+
+def is_gone(error):
+    """Return whether an API error reports that the requested item does not exist (HTTP 404)."""
+    if isinstance(error, HttpError):
+        return error.resp.status == 404
+    return isinstance(error, GmailApiError) and error.status == 404
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt: Retry-After, else full-jitter exponential."""
+    if retry_after:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+class AIMDController:
+    """Adaptive limit on in-flight requests (additive increase, multiplicative decrease).
+
+    Each success raises the limit by 1/limit, i.e. about one request per
+    window. Throttling and server errors halve it, at most once per window,
+    and a Retry-After delay pauses new requests until it has passed.
+    """
+
+    def __init__(self, maximum, initial=None, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or max(minimum, maximum // 4))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.epoch = 0
+        self.condition = threading.Condition()
+        self.async_waiters = []
+
+    def _admit_delay(self):
+        """Return 0 if a request may start now, seconds to wait, or None when at the limit."""
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.in_flight < int(self.limit):
+            return 0.0
+        return None
+
+    def acquire(self):
+        """Block until a request may start; returns a token for release()."""
+        with self.condition:
+            while True:
+                delay = self._admit_delay()
+                if delay == 0.0:
+                    self.in_flight += 1
+                    return self.epoch
+                self.condition.wait(delay)
+
+    async def acquire_async(self):
+        """Coroutine version of acquire() for the asyncio engine."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                delay = self._admit_delay()
+                if delay == 0.0:
+                    self.in_flight += 1
+                    return self.epoch
+                waiter = loop.create_future()
+                self.async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, delay)
+            except asyncio.TimeoutError:
+                pass
 
-def get_gmail_service():
-    """Authenticate and return Gmail API service instance."""
+    def release(self, token, outcome='ok', retry_after=None):
+        """Finish a request started under token and adapt the limit to its outcome."""
+        with self.condition:
+            self.in_flight -= 1
+            if outcome == 'ok':
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome in ('throttled', 'transient'):
+                if token == self.epoch:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.epoch += 1
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self.condition.notify_all()
+
+            free = int(self.limit) - self.in_flight
+            while free > 0 and self.async_waiters:
+                waiter = self.async_waiters.pop(0)
+                if not waiter.done():
+                    waiter.get_loop().call_soon_threadsafe(
+                        lambda w=waiter: w.done() or w.set_result(None))
+                    free -= 1
+
+def get_credentials():
+    """Load, refresh or create OAuth credentials."""
     creds = None
     try:
         if os.path.exists('gmail_token.pickle'):
@@ -36,102 +651,1591 @@ def get_gmail_service():
             with open('gmail_token.pickle', 'wb') as token:
                 pickle.dump(creds, token)
 
-        return build('gmail', 'v1', credentials=creds)
+        return creds
     except Exception as error:
         print(f"Authentication error: {error}")
         return None
 
-def get_messages(service, user_id='me', page_token=None):
-    """Retrieve a batch of messages from Gmail."""
+def get_gmail_service(creds=None):
+    """Authenticate and return Gmail API service instance.
+
+    Each service gets its own authorized httplib2 connection, since a
+    service object must not be shared between threads.
+    """
+    if creds is None:
+        creds = get_credentials()
+    if not creds:
+        return None
+    try:
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        return build('gmail', 'v1', http=http)
+    except Exception as error:
+        print(f"Error building Gmail service: {error}")
+        return None
+
+def execute_with_retry(request, method):
+    """Execute an API request under the quota limiter, retrying throttled and transient errors."""
+    for attempt in range(FETCH_MAX_ATTEMPTS):
+        try:
+            quota_limiter.acquire(method)
+            return request.execute()
+        except Exception as error:
+            kind, retry_after = classify_error(error)
+            if kind == 'permanent' or attempt == FETCH_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(backoff_delay(attempt, retry_after))
+
+def get_messages(service, user_id='me', page_token=None, query=None):
+    """Retrieve a batch of messages from Gmail, retrying throttled requests.
+
+    Returns (None, None) if the page could not be retrieved.
+    """
     try:
-        response = service.users().messages().list(
+        response = execute_with_retry(service.users().messages().list(
             userId=user_id,
             pageToken=page_token,
-            maxResults=500
-        ).execute()
+            q=query,
+            maxResults=500,
+            fields=LIST_FIELDS
+        ), 'messages.list')
         return response.get('messages', []), response.get('nextPageToken')
     except Exception as error:
         print(f"Error retrieving messages: {error}")
-        return [], None
+        return None, None
+
+def get_threads(service, user_id='me', page_token=None, query=None):
+    """Retrieve a page of threads, shaped like get_messages: a list of {'id', 'historyId'} dicts.
+
+    Returns (None, None) if the page could not be retrieved.
+    """
+    try:
+        response = execute_with_retry(service.users().threads().list(
+            userId=user_id,
+            pageToken=page_token,
+            q=query,
+            maxResults=500,
+            fields=THREAD_LIST_FIELDS
+        ), 'threads.list')
+        return response.get('threads', []), response.get('nextPageToken')
+    except Exception as error:
+        print(f"Error retrieving threads: {error}")
+        return None, None
+
+def get_current_history_id(service, user_id='me'):
+    """Return the mailbox's current historyId, or None on error."""
+    try:
+        profile = execute_with_retry(service.users().getProfile(
+            userId=user_id, fields=PROFILE_FIELDS), 'getProfile')
+        return profile.get('historyId')
+    except Exception as error:
+        print(f"Error retrieving mailbox profile: {error}")
+        return None
+
+def get_history_changes(service, user_id, start_history_id):
+    """Return (added message IDs, latest historyId) since start_history_id.
+
+    Returns (None, None) when start_history_id has expired (HTTP 404) and a
+    full listing is needed; other errors are raised.
+    """
+    msg_ids = []
+    seen = set()
+    page_token = None
+    latest_history_id = start_history_id
+    while True:
+        try:
+            response = execute_with_retry(service.users().history().list(
+                userId=user_id,
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                pageToken=page_token,
+                maxResults=500,
+                fields=HISTORY_FIELDS
+            ), 'history.list')
+        except HttpError as error:
+            if error.resp.status == 404:
+                return None, None
+            raise
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg_id = added['message']['id']
+                if msg_id not in seen:
+                    seen.add(msg_id)
+                    msg_ids.append(msg_id)
+        latest_history_id = response.get('historyId', latest_history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return msg_ids, latest_history_id
+
+# Fetch result for a message or thread deleted since it was listed. There
+# is nothing left to retry, so it is dropped instead of dead-lettered.
+MESSAGE_GONE = object()
+
+def get_sender_header(message):
+    """Return the raw From header of a metadata response."""
+    sender = get_header(message, 'From')
+    return 'Unknown' if sender is None else sender
+
+def fetch_message(service, user_id, msg_id, controller=None):
+    """Fetch a single message's metadata, None on error, or MESSAGE_GONE if it was deleted.
+
+    Cached responses are returned without a request. Throttled and
+    transient failures are retried; with a controller the request also
+    counts against its adaptive in-flight limit.
+    """
+    message = message_cache.get(msg_id)
+    if message is not None:
+        return message
+    message = fetch_with_retry(service.users().messages().get(
+        userId=user_id,
+        id=msg_id,
+        format='metadata',
+        metadataHeaders=metadata_request.headers,
+        fields=metadata_request.field_mask
+    ), 'messages.get', f"message {msg_id}", controller)
+    if message is not None and message is not MESSAGE_GONE:
+        message_cache.put(msg_id, message)
+    return message
+
+def fetch_thread(service, user_id, thread_id, controller=None):
+    """Fetch the metadata of every message in a thread, and its historyId, in one call.
+
+    Returns None on error, or MESSAGE_GONE if the thread was deleted.
+    """
+    return fetch_with_retry(service.users().threads().get(
+        userId=user_id,
+        id=thread_id,
+        format='metadata',
+        metadataHeaders=metadata_request.headers,
+        fields=f"historyId,messages(id,{metadata_request.field_mask})"
+    ), 'threads.get', f"thread {thread_id}", controller)
+
+def fetch_with_retry(request, method, description, controller=None):
+    """Execute a per-item request, retrying throttled and transient failures.
+
+    With a controller the request counts against its adaptive in-flight
+    limit. Returns None once the item fails permanently or runs out of
+    attempts, and MESSAGE_GONE if it no longer exists.
+    """
+    for attempt in range(FETCH_MAX_ATTEMPTS):
+        token = controller.acquire() if controller else None
+        try:
+            quota_limiter.acquire(method)
+            response = request.execute()
+        except Exception as error:
+            kind, retry_after = classify_error(error)
+            if controller:
+                controller.release(token, kind, retry_after)
+            if is_gone(error):
+                print(f"Skipping {description}: it no longer exists")
+                return MESSAGE_GONE
+            if kind == 'permanent' or attempt == FETCH_MAX_ATTEMPTS - 1:
+                print(f"Error analyzing {description}: {error}")
+                return None
+            time.sleep(backoff_delay(attempt, retry_after))
+            continue
+        if controller:
+            controller.release(token)
+        return response
+
+def message_facts(message):
+    """Return (internalDate in ms, sizeEstimate, labelIds) of a metadata response."""
+    return (int(message.get('internalDate', 0)), int(message.get('sizeEstimate', 0)),
+            message.get('labelIds', []))
+
+def analyze_metadata(message):
+    """Return (name, email, raw From header, message) for a metadata response.
+
+    The response itself is passed along for the fact store and analyzers.
+    """
+    sender = get_sender_header(message)
+    names, emails = sender_memo.parse([sender])
+    return names[0], emails[0], sender, message
+
+def analyze_metadata_page(items):
+    """Analyze a page of (msg_id, message) pairs, parsing their senders in one batch.
+
+    Returns (msg_id, name, email, raw From header, message) tuples. Messages
+    that could not be fetched (None or MESSAGE_GONE) get no sender or header.
+    """
+    fetched = [message is not None and message is not MESSAGE_GONE for _, message in items]
+    senders = [get_sender_header(message) for (_, message), ok in zip(items, fetched) if ok]
+    names, emails = sender_memo.parse(senders)
+    parsed = iter(zip(names, emails, senders))
+    return [(msg_id, *next(parsed), message) if ok else (msg_id, None, None, None, message)
+            for (msg_id, message), ok in zip(items, fetched)]
 
 def analyze_message(service, user_id, msg_id):
     """Analyze a single email message's metadata."""
+    message = fetch_message(service, user_id, msg_id)
+    if message is None or message is MESSAGE_GONE:
+        return None, None, None, message
+    return analyze_metadata(message)
+
+def fetch_messages_batch(service, user_id, msg_ids, on_message, controller=None):
+    """Fetch messages through the batch endpoint, retrying only failed sub-requests.
+
+    on_message(msg_id, message) is called once per message, with None for
+    messages that fail permanently or still fail after retries, and
+    MESSAGE_GONE for deleted ones. Cached messages are answered without a
+    request.
+    """
+    pending = []
+    for msg_id in msg_ids:
+        message = message_cache.get(msg_id)
+        if message is None:
+            pending.append(msg_id)
+        else:
+            on_message(msg_id, message)
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        failed = []
+        for start in range(0, len(pending), BATCH_REQUEST_LIMIT):
+            chunk = pending[start:start + BATCH_REQUEST_LIMIT]
+            answered = set()
+            outcome = {'kind': 'ok', 'retry_after': None}
+
+            def callback(request_id, response, exception):
+                answered.add(request_id)
+                if exception is None:
+                    message_cache.put(request_id, response)
+                    on_message(request_id, response)
+                    return
+                if is_gone(exception):
+                    print(f"Skipping message {request_id}: it no longer exists")
+                    on_message(request_id, MESSAGE_GONE)
+                    return
+                kind, retry_after = classify_error(exception)
+                if kind == 'permanent':
+                    print(f"Error analyzing message {request_id}: {exception}")
+                    on_message(request_id, None)
+                    return
+                failed.append(request_id)
+                if outcome['kind'] != 'throttled':
+                    outcome['kind'] = kind
+                if retry_after:
+                    outcome['retry_after'] = max(outcome['retry_after'] or 0, retry_after)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in chunk:
+                batch.add(service.users().messages().get(
+                    userId=user_id,
+                    id=msg_id,
+                    format='metadata',
+                    metadataHeaders=metadata_request.headers,
+                    fields=metadata_request.field_mask
+                ), request_id=msg_id)
+            token = controller.acquire() if controller else None
+            try:
+                quota_limiter.acquire('messages.get', len(chunk))
+                batch.execute()
+            except Exception as error:
+                print(f"Error executing batch request: {error}")
+                outcome['kind'], outcome['retry_after'] = classify_error(error)
+                failed.extend(msg_id for msg_id in chunk if msg_id not in answered)
+            if controller:
+                controller.release(token, outcome['kind'], outcome['retry_after'])
+
+        if not failed:
+            return
+        pending = failed
+        if attempt < BATCH_MAX_RETRIES:
+            time.sleep(backoff_delay(attempt, outcome['retry_after']))
+
+    for msg_id in pending:
+        print(f"Error analyzing message {msg_id}: failed after {BATCH_MAX_RETRIES} retries")
+        on_message(msg_id, None)
+
+class ListingCursor:
+    """Listing position up to which every dispatched message has been handled.
+
+    Positions are (page_token, offset, msg_id) tuples: the token that
+    requested the page, the index within it and the ID expected there, which
+    lets a resumed run detect a page that has shifted. A position of None
+    means the listing reached the end of the mailbox.
+    """
+
+    def __init__(self, start=None):
+        self.start = start or (None, 0, None)
+        self.lock = threading.Lock()
+        self.next_seq = 0
+        self.outstanding = {}
+        self.remaining = {}
+        self.seq_by_id = {}
+        self.resume_at = self.start
+
+    def dispatch(self, msg_id, position):
+        """Record that msg_id, listed at position, is being fetched."""
+        with self.lock:
+            self.outstanding[self.next_seq] = position
+            self.seq_by_id[msg_id] = self.next_seq
+            self.next_seq += 1
+
+    def advance(self, position):
+        """Record where the lister will continue."""
+        with self.lock:
+            self.resume_at = position
+
+    def expand(self, thread_id, msg_ids):
+        """Hand a dispatched thread's position over to the new messages it contains."""
+        with self.lock:
+            seq = self.seq_by_id.pop(thread_id, None)
+            if seq is None:
+                return
+            if not msg_ids:
+                del self.outstanding[seq]
+                return
+            self.remaining[seq] = len(msg_ids)
+            for msg_id in msg_ids:
+                self.seq_by_id[msg_id] = seq
+
+    def complete(self, msg_id):
+        """Record that msg_id has been aggregated or dead-lettered."""
+        with self.lock:
+            seq = self.seq_by_id.pop(msg_id, None)
+            if seq is None:
+                return
+            remaining = self.remaining.pop(seq, 1) - 1
+            if remaining:
+                self.remaining[seq] = remaining
+            else:
+                del self.outstanding[seq]
+
+    def position(self):
+        """Return the earliest position that still needs work."""
+        with self.lock:
+            if self.outstanding:
+                return self.outstanding[min(self.outstanding)]
+            return self.resume_at
+
+def find_resume_offset(messages, offset, msg_id):
+    """Locate a saved cursor in a re-listed page; None if the page no longer matches."""
+    if msg_id is None:
+        return offset if offset <= len(messages) else None
+    if offset < len(messages) and messages[offset]['id'] == msg_id:
+        return offset
+    for index, message in enumerate(messages):
+        if message['id'] == msg_id:
+            return index
+    return None
+
+def take_unlisted(messages, page_token, next_page_token, offset, skip, room, cursor):
+    """Pick up to room IDs of listed entries that skip(entry) rejects, starting at offset.
+
+    Each pick and the resume position are recorded in cursor. Returns
+    (msg_ids, page_done) where page_done is False if room ran out mid-page.
+    """
+    accepted = []
+    for index in range(offset, len(messages)):
+        msg_id = messages[index]['id']
+        if skip(messages[index]):
+            continue
+        if len(accepted) >= room:
+            cursor.advance((page_token, index, msg_id))
+            return accepted, False
+        cursor.dispatch(msg_id, (page_token, index, msg_id))
+        accepted.append(msg_id)
+    cursor.advance((next_page_token, 0, None) if next_page_token else None)
+    return accepted, True
+
+def iter_listing_pages(service, user_id, cursor, query=None, list_page=get_messages):
+    """Yield (page_token, offset, messages, next_page_token) from the cursor's start.
+
+    Falls back to the first page when the saved position is no longer
+    valid, and stops early if a page cannot be retrieved. list_page is
+    get_messages, or get_threads to list thread IDs instead.
+    """
+    page_token, offset, resume_id = cursor.start
+    resuming = page_token is not None or offset > 0
+    while True:
+        messages, next_page_token = list_page(service, user_id, page_token, query)
+        if resuming:
+            resuming = False
+            if messages is not None:
+                offset = find_resume_offset(messages, offset, resume_id)
+            if messages is None or offset is None:
+                print("Saved listing cursor is no longer valid, restarting from the first page")
+                page_token, offset = None, 0
+                cursor.advance((None, 0, None))
+                continue
+        if messages is None:
+            return
+        yield page_token, offset, messages, next_page_token
+        if not next_page_token:
+            return
+        page_token, offset = next_page_token, 0
+
+def list_stage(creds, user_id, skip, limit, id_queue, fetchers, stop, listing, cursor,
+               list_page=get_messages):
+    """Pipeline stage: page through messages.list (or threads.list) ahead of the fetch stage.
+
+    Listing starts at the cursor's saved position and passes over entries
+    for which skip(entry) is true. Sets listing['complete'] once every
+    listed message has been dispatched.
+    """
+    service = get_gmail_service(creds)
+    dispatched = 0
     try:
-        message = service.users().messages().get(
-            userId=user_id,
-            id=msg_id,
-            format='metadata',
-            metadataHeaders=['From']
-        ).execute()
+        pages = iter_listing_pages(service, user_id, cursor, list_page=list_page) if service else []
+        for page_token, offset, messages, next_page_token in pages:
+            if stop.is_set():
+                break
+            accepted, page_done = take_unlisted(messages, page_token, next_page_token, offset,
+                                                skip, limit - dispatched, cursor)
+            for msg_id in accepted:
+                id_queue.put(msg_id)
+            dispatched += len(accepted)
+            if not page_done:
+                break
+            if not next_page_token:
+                listing['complete'] = True
+            elif dispatched >= limit:
+                break
+    finally:
+        for _ in range(fetchers):
+            id_queue.put(None)
+
+def shard_query(after, before):
+    """Build the messages.list query for a date window given in epoch seconds.
+
+    Gmail does not document whether epoch bounds are inclusive, so windows
+    overlap by a second; duplicates are dropped when dispatching.
+    """
+    terms = []
+    if after is not None:
+        terms.append(f"after:{after - 1}")
+    if before is not None:
+        terms.append(f"before:{before + 1}")
+    return ' '.join(terms)
+
+def estimate_window(service, user_id, after, before):
+    """Estimate how many messages a date window holds; 0 only if it is empty."""
+    response = execute_with_retry(service.users().messages().list(
+        userId=user_id,
+        q=shard_query(after, before),
+        maxResults=1,
+        fields=ESTIMATE_FIELDS
+    ), 'messages.list')
+    if not response.get('messages'):
+        return 0
+    return max(1, response.get('resultSizeEstimate', 1))
+
+def plan_shards(service, user_id, since, until):
+    """Split the mailbox into date windows sized to message density.
+
+    Starts from calendar years between since and until (epoch seconds) and
+    halves any window estimated to exceed SHARD_TARGET_MESSAGES. Open-ended
+    windows catch anything dated before since or after until.
+    """
+    pending = []
+    year = datetime.fromtimestamp(since, timezone.utc).year
+    start = since
+    while start < until:
+        year += 1
+        end = min(until, int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp()))
+        pending.append((start, end))
+        start = end
+
+    windows = []
+    while pending:
+        after, before = pending.pop()
+        estimate = estimate_window(service, user_id, after, before)
+        if estimate > SHARD_TARGET_MESSAGES and before - after > SHARD_MIN_SECONDS:
+            middle = (after + before) // 2
+            pending += [(after, middle), (middle, before)]
+        elif estimate:
+            windows.append((after, before))
+    windows.sort()
+    windows = [(None, since)] + windows + [(until, None)]
+    return [(after, before, (None, 0, None)) for after, before in windows]
+
+class ShardSet:
+    """Date-window shards of a backfill, each listed with its own cursor.
 
-        headers = message.get('payload', {}).get('headers', [])
-        sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
+    Shards are (after, before, position) tuples as kept in the sync state;
+    position is the shard's ListingCursor position, None once it is done.
+    The lock guards the shared dispatch budget and the in-flight owners.
+    """
 
-        sender_name, sender_email = extract_sender_info(sender)
-        return sender_name, sender_email, sender
+    def __init__(self, shards, limit):
+        self.shards = [(after, before, ListingCursor(position))
+                       for after, before, position in shards if position is not None]
+        self.lock = threading.Lock()
+        self.remaining = limit
+        self.owner = {}
+
+    def complete(self, msg_id):
+        """Record that msg_id has been aggregated or dead-lettered."""
+        with self.lock:
+            cursor = self.owner.pop(msg_id, None)
+        if cursor:
+            cursor.complete(msg_id)
+
+    def snapshot(self):
+        """Return the unfinished shards with their positions for the sync state."""
+        shards = [(after, before, cursor.position()) for after, before, cursor in self.shards]
+        return [shard for shard in shards if shard[2] is not None]
+
+def shard_lister(creds, user_id, is_known, shards, shard_queue, id_queue, stop):
+    """Lister thread: list date-window shards from shard_queue until the budget runs out."""
+    service = get_gmail_service(creds)
+    while service and not stop.is_set():
+        try:
+            after, before, cursor = shard_queue.get_nowait()
+        except queue.Empty:
+            return
+        for page_token, offset, messages, next_page_token in iter_listing_pages(
+                service, user_id, cursor, shard_query(after, before)):
+            if stop.is_set():
+                return
+            with shards.lock:
+                accepted, page_done = take_unlisted(
+                    messages, page_token, next_page_token, offset,
+                    lambda message: message['id'] in shards.owner or is_known(message['id']),
+                    shards.remaining, cursor)
+                for msg_id in accepted:
+                    shards.owner[msg_id] = cursor
+                shards.remaining -= len(accepted)
+            for msg_id in accepted:
+                id_queue.put(msg_id)
+            if not page_done:
+                return
+
+def shard_stage(creds, user_id, is_known, shards, listers, id_queue, fetchers, stop, listing):
+    """Pipeline stage: list the shards with concurrent lister threads.
+
+    Sets listing['complete'] once every shard has been listed to its end.
+    """
+    try:
+        shard_queue = queue.Queue()
+        for shard in shards.shards:
+            shard_queue.put(shard)
+        threads = [threading.Thread(target=shard_lister,
+                                    args=(creds, user_id, is_known, shards, shard_queue,
+                                          id_queue, stop),
+                                    daemon=True)
+                   for _ in range(listers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        listing['complete'] = not stop.is_set() and all(
+            cursor.resume_at is None for _, _, cursor in shards.shards)
+    finally:
+        for _ in range(fetchers):
+            id_queue.put(None)
+
+def feed_stage(msg_ids, limit, id_queue, fetchers, stop):
+    """Pipeline stage: feed a fixed list of message IDs instead of listing."""
+    try:
+        for msg_id in msg_ids[:limit]:
+            if stop.is_set():
+                break
+            id_queue.put(msg_id)
+    finally:
+        for _ in range(fetchers):
+            id_queue.put(None)
+
+def fetch_stage(creds, user_id, fetch_mode, id_queue, raw_queue, controller, is_known, cursor,
+                threads):
+    """Pipeline stage: fetch message metadata with this thread's own service.
+
+    In 'threads' mode the IDs are thread IDs; each thread's new messages
+    are passed on one by one, and the cursor waits for all of them.
+    threads maps each fetched thread ID to its historyId and the IDs of
+    those new messages.
+    An unexpected error is passed on to the parse stage and ends this
+    thread's share of the fetching.
+    """
+    try:
+        service = get_gmail_service(creds)
+        done = False
+        while not done:
+            msg_id = id_queue.get()
+            if msg_id is None:
+                break
+            if not service:
+                raw_queue.put((msg_id, None))
+            elif fetch_mode == 'batch':
+                msg_ids = [msg_id]
+                while len(msg_ids) < BATCH_REQUEST_LIMIT:
+                    try:
+                        next_id = id_queue.get(timeout=BATCH_FILL_TIMEOUT)
+                    except queue.Empty:
+                        break
+                    if next_id is None:
+                        done = True
+                        break
+                    msg_ids.append(next_id)
+                fetch_messages_batch(
+                    service, user_id, msg_ids,
+                    lambda request_id, message: raw_queue.put((request_id, message)), controller)
+            elif fetch_mode == 'threads':
+                thread = fetch_thread(service, user_id, msg_id, controller)
+                if thread is None or thread is MESSAGE_GONE:
+                    raw_queue.put((msg_id, thread))
+                    continue
+                messages = [message for message in thread.get('messages', [])
+                            if not is_known(message['id'])]
+                new_ids = [message['id'] for message in messages]
+                cursor.expand(msg_id, new_ids)
+                threads[msg_id] = (thread.get('historyId'), new_ids)
+                for message in messages:
+                    message_cache.put(message['id'], message)
+                    raw_queue.put((message['id'], message))
+            else:
+                raw_queue.put((msg_id, fetch_message(service, user_id, msg_id, controller)))
+    except Exception as error:
+        raw_queue.put(error)
+    finally:
+        raw_queue.put(None)
+
+def parse_stage(raw_queue, result_queue, fetchers):
+    """Pipeline stage: turn raw metadata into pages of (msg_id, name, email, header, message).
+
+    Takes whatever has queued up, to at most PARSE_PAGE_SIZE messages, and
+    parses the page's senders in one batch. Errors from the fetch stage or
+    from parsing are put on result_queue after the page, for the calling
+    thread to raise.
+    """
+    try:
+        remaining = fetchers
+        while remaining:
+            items = [raw_queue.get()]
+            while len(items) < PARSE_PAGE_SIZE:
+                try:
+                    items.append(raw_queue.get_nowait())
+                except queue.Empty:
+                    break
+            fetched = []
+            errors = []
+            for item in items:
+                if item is None:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    errors.append(item)
+                else:
+                    fetched.append(item)
+            page = analyze_metadata_page(fetched)
+            if page:
+                result_queue.put(page)
+            for error in errors:
+                result_queue.put(error)
     except Exception as error:
-        print(f"Error analyzing message {msg_id}: {error}")
-        return None, None, None
+        result_queue.put(error)
+    finally:
+        result_queue.put(None)
+
+def run_pipeline(creds, user_id, is_known, on_page, limit, fetch_mode='single', workers=1,
+                 msg_ids=None, listing=None, cursor=None, shards=None, listers=SHARD_LISTERS,
+                 skip=None, threads=None):
+    """Run list, fetch and parse stages in threads and aggregate on this thread.
+
+    With msg_ids, those IDs are fetched instead of listing the mailbox.
+    With shards, listers threads list date windows concurrently. Otherwise
+    listing resumes from cursor, skipping entries for which skip(entry)
+    is true (by default those with a known ID). listing['complete'] is set
+    when the whole mailbox listing was dispatched. With fetch_mode 'threads'
+    the listing and limit count threads, and each thread is fetched in one
+    call; threads then maps each fetched thread ID to its historyId and the
+    IDs of the messages in it that were not known yet.
+
+    Listing runs ahead of fetching, and bounded queues between the stages
+    apply backpressure. The fetch threads share an AIMD controller, so
+    workers is the ceiling on in-flight requests rather than a fixed count.
+    on_page is called with each parsed page of results, only ever from the
+    calling thread, which therefore stays the sole owner of the aggregate
+    state. An error in a fetch or
+    parse thread is raised here once the results before it are recorded.
+    """
+    stop = threading.Event()
+    controller = AIMDController(workers)
+    listing = {} if listing is None else listing
+    cursor = cursor or ListingCursor()
+    threads = {} if threads is None else threads
+    id_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+    raw_queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+    result_queue = queue.Queue(max(1, PIPELINE_QUEUE_SIZE // PARSE_PAGE_SIZE))
+
+    if msg_ids is not None:
+        stages = [threading.Thread(target=feed_stage,
+                                   args=(msg_ids, limit, id_queue, workers, stop))]
+    elif shards is not None:
+        stages = [threading.Thread(target=shard_stage,
+                                   args=(creds, user_id, is_known, shards, listers, id_queue,
+                                         workers, stop, listing))]
+    else:
+        list_page = get_threads if fetch_mode == 'threads' else get_messages
+        skip = skip or (lambda message: is_known(message['id']))
+        stages = [threading.Thread(target=list_stage,
+                                   args=(creds, user_id, skip, limit, id_queue, workers, stop,
+                                         listing, cursor, list_page))]
+    stages += [threading.Thread(target=fetch_stage,
+                                args=(creds, user_id, fetch_mode, id_queue, raw_queue, controller,
+                                      is_known, cursor, threads))
+               for _ in range(workers)]
+    stages.append(threading.Thread(target=parse_stage, args=(raw_queue, result_queue, workers)))
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
+
+    try:
+        while True:
+            page = result_queue.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            on_page(page)
+    finally:
+        stop.set()
+    return controller
+
+def analyze_cached(is_known, on_page, limit):
+    """Analyze up to limit new messages from the local cache without any API calls."""
+    msg_ids = [msg_id for msg_id in message_cache.ids() if not is_known(msg_id)][:limit]
+    for start in range(0, len(msg_ids), PARSE_PAGE_SIZE):
+        page = [(msg_id, message_cache.get(msg_id))
+                for msg_id in msg_ids[start:start + PARSE_PAGE_SIZE]]
+        on_page(analyze_metadata_page(page))
+
+def reanalyze_cached(is_processed, analyzers=()):
+    """Rebuild the sender aggregate and analyses from cached copies of processed messages.
+
+    Unlike analyze_cached this revisits messages that were already counted,
+    so changed extraction logic applies to all of them.
+    Returns (csv_data, {analysis name: counts}, number of messages).
+    """
+    msg_ids = [msg_id for msg_id in message_cache.ids() if is_processed(msg_id)]
+    csv_data = SenderTable()
+    analyses = {analyzer.name: Counter() for analyzer in analyzers}
+    for start in range(0, len(msg_ids), PARSE_PAGE_SIZE):
+        page = [(msg_id, message_cache.get(msg_id))
+                for msg_id in msg_ids[start:start + PARSE_PAGE_SIZE]]
+        for _, sender_name, sender_email, _, message in analyze_metadata_page(page):
+            if sender_email:
+                csv_data = update_csv_data(csv_data, sender_name, sender_email,
+                                           message_facts(message)[0] or None)
+            for analyzer in analyzers:
+                analyses[analyzer.name].update(analyzer.values(message))
+    return csv_data, analyses, len(msg_ids)
+
+def async_auth_headers(creds):
+    """Return the Authorization header, refreshing the access token when needed."""
+    if not creds.valid and creds.refresh_token:
+        creds.refresh(Request())
+    return {'Authorization': f'Bearer {creds.token}'}
+
+async def async_request_json(session, url, params, creds):
+    """GET a Gmail REST endpoint and decode the JSON body, raising GmailApiError on failure."""
+    async with session.get(url, params=params, headers=async_auth_headers(creds)) as resp:
+        if resp.status >= 400:
+            raise GmailApiError(resp.status, await resp.text(), resp.headers)
+        return await resp.json()
+
+async def async_get_messages(session, api_root, creds, user_id='me', page_token=None):
+    """Retrieve a batch of messages through the users.messages.list REST endpoint.
+
+    Returns (None, None) if the page could not be retrieved.
+    """
+    params = {'maxResults': 500, 'fields': LIST_FIELDS}
+    if page_token:
+        params['pageToken'] = page_token
+    for attempt in range(FETCH_MAX_ATTEMPTS):
+        try:
+            await asyncio.sleep(quota_limiter.reserve('messages.list'))
+            response = await async_request_json(
+                session, f"{api_root}/users/{user_id}/messages", params, creds)
+            return response.get('messages', []), response.get('nextPageToken')
+        except Exception as error:
+            kind, retry_after = classify_error(error)
+            if kind == 'permanent' or attempt == FETCH_MAX_ATTEMPTS - 1:
+                print(f"Error retrieving messages: {error}")
+                return None, None
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+async def async_fetch_message(session, controller, api_root, creds, user_id, msg_id):
+    """Fetch a message's metadata through the users.messages.get REST endpoint.
+
+    Returns None on error, or MESSAGE_GONE if the message was deleted.
+    """
+    message = message_cache.get(msg_id)
+    if message is not None:
+        return message
+    params = ([('format', 'metadata'), ('fields', metadata_request.field_mask)]
+              + [('metadataHeaders', name) for name in metadata_request.headers])
+    for attempt in range(FETCH_MAX_ATTEMPTS):
+        token = await controller.acquire_async()
+        try:
+            await asyncio.sleep(quota_limiter.reserve('messages.get'))
+            message = await async_request_json(
+                session, f"{api_root}/users/{user_id}/messages/{msg_id}", params, creds)
+        except Exception as error:
+            kind, retry_after = classify_error(error)
+            controller.release(token, kind, retry_after)
+            if is_gone(error):
+                print(f"Skipping message {msg_id}: it no longer exists")
+                return MESSAGE_GONE
+            if kind == 'permanent' or attempt == FETCH_MAX_ATTEMPTS - 1:
+                print(f"Error analyzing message {msg_id}: {error}")
+                return None
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+            continue
+        controller.release(token)
+        message_cache.put(msg_id, message)
+        return message
+
+async def run_async_engine(creds, user_id, is_known, on_page, limit,
+                           api_root=GMAIL_API_ROOT, max_in_flight=ASYNC_MAX_IN_FLIGHT,
+                           msg_ids=None, listing=None, cursor=None):
+    """Fetch and analyze up to limit new messages on one event loop.
+
+    With msg_ids, those IDs are fetched instead of listing the mailbox.
+    Otherwise listing resumes from cursor, and listing['complete'] is set
+    when the whole mailbox listing was dispatched.
+
+    An AIMD controller bounds the number of in-flight messages.get requests
+    (never more than max_in_flight); the next list page is requested while
+    the current page is being fetched. Each page of messages has its
+    senders parsed in one batch and is passed to on_page, which runs on the
+    event loop thread, which owns the aggregate state.
+    """
+    if aiohttp is None:
+        raise RuntimeError("The asyncio engine requires the 'aiohttp' package")
+
+    controller = AIMDController(max_in_flight)
+    listing = {} if listing is None else listing
+    cursor = cursor or ListingCursor()
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    dispatched = 0
+
+    async def analyze(page_ids):
+        messages = await asyncio.gather(*(
+            async_fetch_message(session, controller, api_root, creds, user_id, msg_id)
+            for msg_id in page_ids))
+        on_page(analyze_metadata_page(list(zip(page_ids, messages))))
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        if msg_ids is not None:
+            msg_ids = msg_ids[:limit]
+            for start in range(0, len(msg_ids), PARSE_PAGE_SIZE):
+                await analyze(msg_ids[start:start + PARSE_PAGE_SIZE])
+            return controller
+
+        page_token, offset, resume_id = cursor.start
+        messages, next_page_token = await async_get_messages(
+            session, api_root, creds, user_id, page_token)
+        if page_token is not None or offset > 0:
+            if messages is not None:
+                offset = find_resume_offset(messages, offset, resume_id)
+            if messages is None or offset is None:
+                print("Saved listing cursor is no longer valid, restarting from the first page")
+                page_token, offset = None, 0
+                cursor.advance((None, 0, None))
+                messages, next_page_token = await async_get_messages(
+                    session, api_root, creds, user_id)
+
+        while messages is not None and dispatched < limit:
+            next_page = None
+            if next_page_token:
+                next_page = asyncio.ensure_future(
+                    async_get_messages(session, api_root, creds, user_id, next_page_token))
+
+            accepted, page_done = take_unlisted(messages, page_token, next_page_token, offset,
+                                                lambda message: is_known(message['id']),
+                                                limit - dispatched, cursor)
+            dispatched += len(accepted)
+            await analyze(accepted)
+
+            if not next_page:
+                listing['complete'] = page_done
+                break
+            if not page_done or dispatched >= limit:
+                next_page.cancel()
+                break
+            page_token, offset = next_page_token, 0
+            messages, next_page_token = await next_page
+    return controller
 
 def extract_sender_info(sender):
-    """Extract sender name and email using email.utils.parseaddr."""
-    name, email_address = email.utils.parseaddr(sender)
-    name = name.strip() if name else None
-
-    # Validate email
-    email_regex = re.compile(r'^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}$', re.IGNORECASE)
-    valid_email = None
-    if email_address:
-        email_address = email_address.strip().lower()
-        if email_regex.match(email_address):
-            valid_email = email_address
-    return name, valid_email
-
-def load_processed_data():
-    """Load both processed IDs and CSV data with integrity checks."""
-    processed_ids = set()
-    csv_data = {}
+    """Extract sender name and email from one From value (see extract_senders_batch)."""
+    names, emails = extract_senders_batch([sender])
+    return names[0], emails[0]
 
-    # Load processed IDs
-    if Path(PICKLE_FILENAME).exists():
+@functools.lru_cache(maxsize=DISPLAY_NAME_CACHE_SIZE)
+def normalize_display_name(name):
+    """Decode RFC 2047 encoded words in a display name and normalize it.
+
+    The result is NFKC-normalized with runs of whitespace collapsed.
+    Names that fail to decode are kept as they are.
+    """
+    if '=?' in name:
         try:
-            with open(PICKLE_FILENAME, 'rb') as f:
-                processed_ids = pickle.load(f)
-                if not isinstance(processed_ids, set):
-                    raise ValueError("Invalid processed IDs format")
-        except (EOFError, pickle.UnpicklingError) as e:
-            print(f"Corrupted {PICKLE_FILENAME}, resetting...")
-            processed_ids = set()
+            name = str(email.header.make_header(email.header.decode_header(name))) or name
+        except (LookupError, ValueError, email.errors.HeaderParseError):
+            pass
+    return ' '.join(unicodedata.normalize('NFKC', name).split())
+
+def extract_senders_batch(senders):
+    """Parse raw From values into (names, emails) columns.
+
+    The common `Name <addr>`, `"Name" <addr>` and bare address shapes are
+    matched by one precompiled pattern; anything else falls back to
+    email.utils.parseaddr. Names are decoded and normalized by
+    normalize_display_name(), and addresses are validated.
+    """
+    names = []
+    emails = []
+    match_sender = SENDER_PATTERN.fullmatch
+    match_email = EMAIL_PATTERN.match
+    for sender in senders:
+        match = match_sender(sender)
+        if match:
+            quoted, name, email_address, bare = match.group('quoted', 'name', 'address', 'bare')
+            if bare:
+                name, email_address = '', bare
+            elif quoted is not None:
+                name = quoted
+            else:
+                # parseaddr collapses whitespace between the words of an unquoted name
+                name = ' '.join(name.split())
+        else:
+            name, email_address = email.utils.parseaddr(sender)
+        names.append(normalize_display_name(name) if name else None)
+
+        # Validate email
+        valid_email = None
+        if email_address:
+            email_address = email_address.strip().lower()
+            if match_email(email_address):
+                valid_email = email_address
+        emails.append(valid_email)
+    return names, emails
+
+class SenderMemo:
+    """Bounded LRU memo of parsed From headers, keyed on the raw value.
+
+    Sits in front of extract_senders_batch(): a mailbox's senders are
+    heavily skewed, so most headers were parsed before. The memo can be
+    saved between runs; entries from another SENDER_PARSER_VERSION are
+    discarded on load. Disabled until configured.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.capacity = 0
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, capacity, path=None):
+        """Set the size bound; with a path, load the saved memo and save it on close."""
+        self.capacity = capacity
+        self.path = path if capacity > 0 else None
+        if self.path and Path(self.path).exists():
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if saved['version'] == SENDER_PARSER_VERSION:
+                    for sender, sender_name, sender_email in saved['entries'][-capacity:]:
+                        self.entries[sender] = (sender_name, sender_email)
+            except (ValueError, KeyError, TypeError):
+                print(f"Corrupted {self.path}, resetting...")
+                self.entries.clear()
+
+    def parse(self, senders):
+        """Return (names, emails) columns like extract_senders_batch()."""
+        if self.capacity <= 0:
+            return extract_senders_batch(senders)
+        with self.lock:
+            results = []
+            missing = {}
+            for sender in senders:
+                result = self.entries.get(sender)
+                if result is None:
+                    missing[sender] = None
+                else:
+                    self.entries.move_to_end(sender)
+                results.append(result)
+            # A miss is a parse; repeats of a new value within the page count as hits
+            self.misses += len(missing)
+            self.hits += len(senders) - len(missing)
+            if missing:
+                names, emails = extract_senders_batch(list(missing))
+                for sender, sender_name, sender_email in zip(missing, names, emails):
+                    missing[sender] = self.entries[sender] = (sender_name, sender_email)
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last=False)
+                results = [missing[sender] if result is None else result
+                           for sender, result in zip(senders, results)]
+        return [result[0] for result in results], [result[1] for result in results]
+
+    def close(self):
+        """Save the memo, least recently used entries first."""
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': SENDER_PARSER_VERSION,
+                       'entries': [[sender, *result] for sender, result in self.entries.items()]}, f)
+        os.replace(temp_path, self.path)
+
+sender_memo = SenderMemo()
+
+def get_header(message, name):
+    """Return the first value of a header in a metadata response, or None."""
+    name = name.lower()
+    headers = message.get('payload', {}).get('headers', [])
+    return next((h['value'] for h in headers if h['name'].lower() == name), None)
+
+def extract_list_id(value):
+    """Return the list identifier of a List-Id header (the part in angle brackets)."""
+    match = LIST_ID_PATTERN.search(value)
+    return [(match.group(1) if match else value).strip().lower()]
+
+def extract_addresses(value):
+    """Return every address in an address-list header such as To or Return-Path."""
+    return [address.strip().lower() for _, address in email.utils.getaddresses([value]) if address]
+
+def extract_subject_prefix(value):
+    """Return the chain of reply/forward markers and [tags] a subject starts with."""
+    prefixes = []
+    position = 0
+    while True:
+        match = SUBJECT_PREFIX_PATTERN.match(value, position)
+        if not match:
+            break
+        marker = match.group(1)
+        prefixes.append(f"{marker.lower()}:" if marker else match.group(0).strip().lower())
+        position = match.end()
+    return [' '.join(prefixes) or '(none)']
+
+class HeaderAnalyzer:
+    """Extracts the values of one header that an analysis counts.
+
+    Analyzers run in the same pass as the sender analysis: messages.get
+    requests the union of the headers and fields that the enabled
+    analyzers declare. The store counts the values and keeps them with
+    the message's log record, so analysis counts are recovered after a
+    crash like the sender stats, and each analysis has its own CSV export.
+    """
+
+    fields = ['payload/headers(name,value)']
+
+    def __init__(self, name):
+        self.name = name
+        self.header, self.column, self.filename, self.extract = ANALYZERS[name]
+        self.headers = [self.header]
+
+    def values(self, message):
+        value = get_header(message, self.header)
+        return [] if value is None else self.extract(value)
+
+def read_counts(filename, column):
+    """Load a two-column CSV of counts into a Counter (empty if missing or corrupted)."""
+    counts = Counter()
+    if Path(filename).exists():
+        try:
+            with open(filename, 'r', newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    counts[row[column]] += int(row['count'])
+        except (csv.Error, KeyError, ValueError):
+            print(f"Corrupted {filename}, resetting...")
+            counts = Counter()
+    return counts
+
+def write_counts(path, column, rows):
+    """Write (value, count) rows as a two-column CSV and flush it to stable storage."""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow([column, 'count'])
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+
+def export_counts(filename, column, rows):
+    """Atomically replace filename with a CSV of (value, count) rows."""
+    temp_path = f"{filename}.tmp"
+    write_counts(temp_path, column, rows)
+    os.replace(temp_path, filename)
+
+ANALYZERS = {  # name: (header, CSV column, export file, extract function)
+    'list-id': ('List-Id', 'List-Id', 'list_ids.csv', extract_list_id),
+    'return-path': ('Return-Path', 'Return-Path', 'return_paths.csv', extract_addresses),
+    'to': ('To', 'Recipient', 'recipients.csv', extract_addresses),
+    'subject': ('Subject', 'Subject prefix', 'subject_prefixes.csv', extract_subject_prefix),
+}
+
+class PublicSuffixTrie:
+    """Public Suffix List rules in a trie of reversed domain labels.
+
+    Each node maps the next label (read from the TLD down) to its child,
+    and RULE marks a node where a rule ends: True for normal and wildcard
+    rules, False for exception (!) rules. A lookup visits one node per
+    label, however many rules there are. The list is read on first use.
+    """
+
+    RULE = '.'  # Never a label, so it cannot clash with a child
+
+    def __init__(self, path):
+        self.path = path
+        self.root = None
+
+    def load(self):
+        self.root = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    # A rule is the first whitespace-separated token on its line
+                    tokens = line.split()
+                    if tokens and not tokens[0].startswith('//'):
+                        self.add(tokens[0])
+        except OSError as error:
+            print(f"Cannot read {self.path} ({error}), using top-level domains as public suffixes")
+
+    def add(self, rule):
+        exception = rule.startswith('!')
+        rule = rule.lstrip('!').lower()
+        spellings = {rule}
+        if not rule.isascii():
+            # The list spells IDN rules in Unicode, but addresses use the ASCII form
+            try:
+                spellings.add(rule.encode('idna').decode('ascii'))
+            except UnicodeError:
+                pass
+        for spelling in spellings:
+            node = self.root
+            for label in reversed(spelling.split('.')):
+                node = node.setdefault(label, {})
+            node[self.RULE] = not exception
+
+    def suffix_length(self, labels):
+        """Return how many trailing labels of a domain form its public suffix."""
+        if self.root is None:
+            self.load()
+        node = self.root
+        length = 1  # An unlisted TLD is a public suffix by itself
+        for depth, label in enumerate(reversed(labels)):
+            child = node.get(label)
+            if child is not None and child.get(self.RULE) is False:
+                # Exceptions win, and end one label short of the rule
+                return depth
+            wildcard = node.get('*')
+            if wildcard is not None and wildcard.get(self.RULE):
+                length = depth + 1
+            if child is None:
+                break
+            if child.get(self.RULE):
+                length = depth + 1
+            node = child
+        return length
+
+public_suffixes = PublicSuffixTrie(Path(__file__).with_name(PUBLIC_SUFFIX_FILENAME))
+
+def email_domain(sender_email):
+    return sender_email.rpartition('@')[2]
+
+@functools.lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def registrable_domain(domain):
+    """Return the registrable domain (eTLD+1) of a domain.
+
+    A domain that is itself a public suffix is returned unchanged.
+    """
+    labels = domain.split('.')
+    length = public_suffixes.suffix_length(labels)
+    return '.'.join(labels[-length - 1:]) if len(labels) > length else domain
+
+def sender_organization(sender_email):
+    return registrable_domain(email_domain(sender_email))
+
+class DomainRollup:
+    """Message counts per sender domain, with its own CSV export.
+
+    A rollup is seeded from the sender aggregate at the start of a run and
+    then counts every recorded message, so it always agrees with the
+    sender stats, including after --reaggregate.
+    """
+
+    def __init__(self, column, filename, extract):
+        self.column = column
+        self.filename = filename
+        self.extract = extract
+        self.counts = Counter()
+
+    def load(self, senders):
+        """Start from (name, email, count, first_seen, last_seen) sender rows."""
+        self.counts = Counter()
+        for _, sender_email, count, _, _ in senders:
+            self.add(sender_email, count)
+
+    def add(self, sender_email, count=1):
+        self.counts[self.extract(sender_email)] += count
+
+    def export(self):
+        export_counts(self.filename, self.column, self.counts.most_common())
+
+ROLLUPS = {  # name: (CSV column, export file, extract function)
+    'domain': ('Domain', 'sender_domains.csv', email_domain),
+    'organization': ('Registrable domain', 'sender_organizations.csv', sender_organization),
+}
+
+def load_rollups(store):
+    """Return every rollup, seeded from the store's sender aggregate."""
+    senders = store.top_senders(store.sender_count())
+    rollups = [DomainRollup(*spec) for spec in ROLLUPS.values()]
+    for rollup in rollups:
+        rollup.load(senders)
+    return rollups
+
+class ProcessedIdSet:
+    """Set of Gmail message IDs stored as packed 64-bit integers.
+
+    Gmail message IDs are 64-bit values in hex. Processed IDs live in a
+    sorted base file (header followed by little-endian uint64 values) that
+    is memory-mapped and searched with bisect, so opening it costs the same
+    for any mailbox size. IDs added since the last compaction are appended
+    to a sidecar file and kept in a small in-memory set; compaction merges
+    the sidecar into a new base file once it holds IDS_SIDECAR_LIMIT IDs.
+    """
+
+    def __init__(self, path=IDS_FILENAME, sidecar_path=IDS_SIDECAR_FILENAME):
+        self.path = path
+        self.sidecar_path = sidecar_path
+        self.buffer = set()
+        self.unsaved = []
+        self.mm = None
+        self.view = None
+        self.base = array('Q')
+
+    @staticmethod
+    def write_base(path, values):
+        """Atomically write sorted values as a base file, dropping duplicates."""
+        temp_path = f"{path}.tmp"
+        count = 0
+        previous = None
+        chunk = array('Q')
+
+        def flush(f):
+            if sys.byteorder != 'little':
+                chunk.byteswap()
+            f.write(chunk.tobytes())
+            del chunk[:]
+
+        with open(temp_path, 'wb') as f:
+            f.write(IDS_HEADER.pack(IDS_MAGIC, IDS_VERSION, 0))
+            for value in values:
+                if value == previous:
+                    continue
+                previous = value
+                chunk.append(value)
+                count += 1
+                if len(chunk) >= IDS_WRITE_CHUNK:
+                    flush(f)
+            flush(f)
+            f.seek(0)
+            f.write(IDS_HEADER.pack(IDS_MAGIC, IDS_VERSION, count))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def open(cls, path=IDS_FILENAME, sidecar_path=IDS_SIDECAR_FILENAME):
+        """Map an existing base file (creating an empty one) and load its sidecar.
+
+        Raises ValueError if either file is invalid.
+        """
+        if not Path(path).exists():
+            cls.write_base(path, [])
+        processed_ids = cls(path, sidecar_path)
+        processed_ids.map()
+        if Path(sidecar_path).exists():
+            pending = array('Q')
+            with open(sidecar_path, 'rb') as f:
+                data = f.read()
+            # Ignore a torn final record from an interrupted append
+            pending.frombytes(data[:len(data) - len(data) % pending.itemsize])
+            if sys.byteorder != 'little':
+                pending.byteswap()
+            processed_ids.buffer.update(pending)
+        return processed_ids
+
+    def map(self):
+        """Map the base file; big-endian hosts load a byte-swapped copy instead."""
+        with open(self.path, 'rb') as f:
+            header = f.read(IDS_HEADER.size)
+            if len(header) != IDS_HEADER.size:
+                raise ValueError("truncated header")
+            magic, version, count = IDS_HEADER.unpack(header)
+            if magic != IDS_MAGIC or version != IDS_VERSION:
+                raise ValueError(f"unsupported format {magic!r} v{version}")
+            if os.fstat(f.fileno()).st_size != IDS_HEADER.size + count * 8:
+                raise ValueError("length does not match header")
+            if sys.byteorder != 'little':
+                self.base = array('Q', f.read())
+                self.base.byteswap()
+                return
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        self.base = self.view[IDS_HEADER.size:].cast('Q')
+
+    def close(self):
+        """Release the mapping of the base file."""
+        if self.mm is not None:
+            self.base.release()
+            self.view.release()
+            self.mm.close()
+            self.mm = None
+            self.view = None
+        self.base = array('Q')
+
+    def __contains__(self, msg_id):
+        try:
+            value = int(msg_id, 16)
+        except (TypeError, ValueError):
+            return False
+        if value in self.buffer:
+            return True
+        index = bisect_left(self.base, value)
+        return index < len(self.base) and self.base[index] == value
+
+    def __len__(self):
+        return len(self.base) + len(self.buffer)
+
+    def __iter__(self):
+        for value in merge(self.base, sorted(self.buffer)):
+            yield format(value, 'x')
+
+    def add(self, msg_id):
+        if msg_id in self:
+            return
+        value = int(msg_id, 16)
+        self.buffer.add(value)
+        self.unsaved.append(value)
+
+    def save(self, compact=True):
+        """Append new IDs to the sidecar, compacting it into the base when it is large.
+
+        Pass compact=False while other threads may still be looking up IDs.
+        """
+        if self.unsaved:
+            pending = array('Q', self.unsaved)
+            if sys.byteorder != 'little':
+                pending.byteswap()
+            with open(self.sidecar_path, 'ab') as f:
+                f.write(pending.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self.unsaved = []
+        if compact and len(self.buffer) >= IDS_SIDECAR_LIMIT:
+            self.compact()
+
+    def compact(self):
+        """Merge the sidecar into a new base file and map that instead."""
+        self.write_base(f"{self.path}.merged", merge(self.base, sorted(self.buffer)))
+        self.close()
+        os.replace(f"{self.path}.merged", self.path)
+        # Sidecar IDs are in the base now; truncating after the replace
+        # means a crash in between only leaves harmless duplicates.
+        open(self.sidecar_path, 'wb').close()
+        self.buffer = set()
+        self.map()
+
+def migrate_pickled_ids():
+    """Convert the legacy processed_ids.pickle set into the binary ID store."""
+    try:
+        with open(PICKLE_FILENAME, 'rb') as f:
+            legacy_ids = pickle.load(f)
+            if not isinstance(legacy_ids, set):
+                raise ValueError("Invalid processed IDs format")
+        ProcessedIdSet.write_base(IDS_FILENAME, sorted(int(msg_id, 16) for msg_id in legacy_ids))
+    except (EOFError, ValueError, pickle.UnpicklingError):
+        print(f"Corrupted {PICKLE_FILENAME}, resetting...")
+        return
+
+    os.replace(PICKLE_FILENAME, f"{PICKLE_FILENAME}.bak")
+    print(f"Migrated {len(legacy_ids)} processed IDs from {PICKLE_FILENAME} to {IDS_FILENAME}")
+
+def legacy_display_names(raw_senders):
+    """Map sender keys of rows exported before names were decoded to decoded names.
+
+    Those rows hold encoded words in lower case, and base64 cannot be
+    decoded after that, so names are recovered from raw From headers.
+    """
+    names = {}
+    for sender in raw_senders:
+        if '=?' in sender:
+            name, address = email.utils.parseaddr(sender)
+            if name and address:
+                names[sender_key(name, address)] = normalize_display_name(name)
+    return names
+
+def load_processed_data(raw_senders=()):
+    """Load both processed IDs and CSV data with integrity checks.
+
+    raw_senders (the fact store's From headers) help decode the names of
+    rows exported by older versions.
+    """
+    csv_data = SenderTable()
+
+    # Load processed IDs
+    if not Path(IDS_FILENAME).exists() and Path(PICKLE_FILENAME).exists():
+        migrate_pickled_ids()
+    try:
+        processed_ids = ProcessedIdSet.open()
+    except ValueError as e:
+        print(f"Corrupted {IDS_FILENAME} ({e}), resetting...")
+        ProcessedIdSet.write_base(IDS_FILENAME, [])
+        Path(IDS_SIDECAR_FILENAME).unlink(missing_ok=True)
+        processed_ids = ProcessedIdSet.open()
 
     # Load CSV data
     if Path(CSV_FILENAME).exists():
         try:
             with open(CSV_FILENAME, 'r', newline='', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
+                now = int(time.time() * 1000)
+                legacy_names = None
                 for row in reader:
-                    key = (row['Email Address'].strip().lower(), row['Service/Company Name'].strip().lower())
-                    csv_data[key] = {
-                        'count': int(row['count']),
-                        'first_seen': row.get('first_seen', datetime.now().isoformat()),
-                        'last_seen': row.get('last_seen', datetime.now().isoformat())
-                    }
-        except (csv.Error, KeyError) as e:
+                    # "Unknown" is exported for senders without a display name
+                    name = row['Service/Company Name'].strip()
+                    key = sender_key(None if name == "Unknown" else name, row['Email Address'])
+                    if '=?' in name:
+                        if legacy_names is None:
+                            legacy_names = legacy_display_names(raw_senders)
+                        if key in legacy_names:
+                            name = legacy_names[key]
+                        elif not BASE64_WORD_PATTERN.search(name):
+                            # Quoted-printable words still decode in lower case
+                            name = normalize_display_name(name)
+                        key = sender_key(name, row['Email Address'])
+                    csv_data.add(key, parse_seen(row.get('first_seen') or now), int(row['count']),
+                                 parse_seen(row.get('last_seen') or now))
+        except (csv.Error, KeyError, ValueError) as e:
             print(f"Corrupted {CSV_FILENAME}, resetting...")
-            csv_data = {}
+            csv_data = SenderTable()
 
     return processed_ids, csv_data
 
-def save_data(processed_ids, csv_data):
-    """Atomic save operations for both data stores."""
-    # Save processed IDs
-    temp_pickle = f"{PICKLE_FILENAME}.tmp"
-    with open(temp_pickle, 'wb') as f:
-        pickle.dump(processed_ids, f)
-    os.replace(temp_pickle, PICKLE_FILENAME)
+class AnalysisLog:
+    """Append-only write-ahead log of aggregated messages.
 
-    # Save CSV data
-    temp_csv = f"{CSV_FILENAME}.tmp"
-    with open(temp_csv, 'w', newline='', encoding='utf-8') as f:
+    Each record is a JSON line [seq, msg_id, email, name, seen], followed
+    by {analysis: [values]} when analyses extracted any values. Records
+    are buffered and written and fsynced every WAL_SYNC_RECORDS appends,
+    and a checkpoint folds them into the CSV snapshot. Records with a seq
+    above the checkpoint's folded seq are replayed on startup, so replay is
+    idempotent. before_sync runs ahead of every write, so data the records
+    depend on (the fact rows) is always durable first.
+    """
+
+    def __init__(self, path=WAL_FILENAME, before_sync=None):
+        self.path = path
+        self.before_sync = before_sync
+        self.file = None
+        self.seq = 0
+        self.folded_seq = 0
+        self.unsynced = []
+        self.records = 0
+
+    def replay(self, folded_seq):
+        """Yield every record with its seq, then open the log for appending.
+
+        Records up to folded_seq are already in the CSV snapshot; they are
+        still yielded for snapshots that may lag behind it.
+        """
+        self.seq = self.folded_seq = folded_seq
+        good_offset = 0
+        if Path(self.path).exists():
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        seq, msg_id, sender_email, sender_name, seen = record[:5]
+                    except ValueError:
+                        print(f"Ignoring torn record at the end of {self.path}")
+                        break
+                    good_offset += len(line)
+                    self.seq = max(self.seq, seq)
+                    if seq > folded_seq:
+                        self.records += 1
+                    analyses = record[5] if len(record) > 5 else {}
+                    yield seq, msg_id, sender_email, sender_name, seen, analyses
+            os.truncate(self.path, good_offset)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def append(self, msg_id, sender_email, sender_name, seen, analyses=None):
+        self.seq += 1
+        record = [self.seq, msg_id, sender_email, sender_name, seen]
+        if analyses:
+            record.append(analyses)
+        self.unsynced.append(json.dumps(record) + '\n')
+        self.records += 1
+        if len(self.unsynced) >= WAL_SYNC_RECORDS:
+            self.sync()
+
+    def sync(self):
+        """Write appended records and flush them to stable storage."""
+        if self.file and self.unsynced:
+            if self.before_sync:
+                self.before_sync()
+            self.file.writelines(self.unsynced)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = []
+
+    def truncate(self):
+        """Drop all records once a checkpoint has folded them into the snapshot."""
+        self.file.close()
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.folded_seq = self.seq
+        self.records = 0
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_checkpoint():
+    """Return the last checkpoint, or None to replay the whole log."""
+    if not Path(CHECKPOINT_FILENAME).exists():
+        return None
+    try:
+        with open(CHECKPOINT_FILENAME, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if not {'seq', 'previous_seq', 'csv_sha256'} <= checkpoint.keys():
+            raise KeyError('incomplete checkpoint')
+        return checkpoint
+    except (ValueError, KeyError):
+        print(f"Corrupted {CHECKPOINT_FILENAME}, replaying the whole log...")
+        return None
+
+def folded_seq(checkpoint, path, digest):
+    """Return the last log seq that the snapshot at path already includes.
+
+    The checkpoint names the digest of each snapshot it was written for.
+    If the file on disk differs, the run stopped before replacing it, and
+    the previous checkpoint's seq applies. A snapshot the checkpoint does
+    not name (digest None) had no records in the log it folded.
+    """
+    if checkpoint is None:
+        return 0
+    if digest is None or (Path(path).exists() and file_sha256(path) == digest):
+        return checkpoint['seq']
+    return checkpoint['previous_seq']
+
+def write_csv(path, rows):
+    """Write sender rows to a CSV file and flush it to stable storage.
+
+    Rows are (name, email, count, first_seen, last_seen) with timestamps
+    in epoch ms; this is where they are formatted.
+    """
+    with open(path, 'w', newline='', encoding='utf-8') as f:
         writer = csv.DictWriter(f, fieldnames=[
             'Service/Company Name', 
             'Email Address', 
@@ -140,87 +2244,965 @@ def save_data(processed_ids, csv_data):
             'last_seen'
         ])
         writer.writeheader()
-        for (email, name), data in csv_data.items():
+        for name, email, count, first_seen, last_seen in rows:
             writer.writerow({
                 'Service/Company Name': name,
                 'Email Address': email,
-                'count': data['count'],
-                'first_seen': data['first_seen'],
-                'last_seen': data['last_seen']
+                'count': count,
+                'first_seen': format_seen(first_seen),
+                'last_seen': format_seen(last_seen)
             })
+        f.flush()
+        os.fsync(f.fileno())
+
+def save_data(processed_ids, csv_data, log=None, compact_ids=True, analyses=None):
+    """Atomic save operations for both data stores.
+
+    With a log this is a checkpoint. The log is synced first. A checkpoint
+    naming the digests of the new CSV and analysis exports is written
+    before they replace the old ones, and the log is truncated afterwards,
+    so a crash at any point leaves a state that replays exactly once.
+    analyses maps analysis names to their counts.
+    """
+    if log:
+        log.sync()
+
+    # Save processed IDs
+    processed_ids.save(compact_ids)
+
+    # Save CSV data
+    temp_csv = f"{CSV_FILENAME}.tmp"
+    write_csv(temp_csv, csv_data.rows())
+    exports = {}
+    for name, counts in (analyses or {}).items():
+        _, column, filename, _ = ANALYZERS[name]
+        write_counts(f"{filename}.tmp", column, counts.most_common())
+        exports[name] = filename
+
+    if log:
+        temp_checkpoint = f"{CHECKPOINT_FILENAME}.tmp"
+        with open(temp_checkpoint, 'w', encoding='utf-8') as f:
+            json.dump({'seq': log.seq, 'csv_sha256': file_sha256(temp_csv),
+                       'previous_seq': log.folded_seq,
+                       'analysis_sha256': {name: file_sha256(f"{filename}.tmp")
+                                           for name, filename in exports.items()}}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_checkpoint, CHECKPOINT_FILENAME)
     os.replace(temp_csv, CSV_FILENAME)
+    for filename in exports.values():
+        os.replace(f"{filename}.tmp", filename)
+    if log:
+        log.truncate()
 
-def update_csv_data(csv_data, sender_name, sender_email):
-    """Update CSV data with new entry."""
-    current_time = datetime.now().isoformat()
-    key = (sender_email.strip().lower(), sender_name.strip().lower() if sender_name else "Unknown")
+def checkpoint_due(log, csv_data, minimum=WAL_COMPACT_MIN):
+    """Fold the log once it rivals the snapshot in size, keeping saves proportional to new work."""
+    return log.records >= max(minimum, len(csv_data), 1)
 
-    if key in csv_data:
-        csv_data[key]['count'] += 1
-        csv_data[key]['last_seen'] = current_time
-    else:
-        csv_data[key] = {
-            'count': 1,
-            'first_seen': current_time,
-            'last_seen': current_time
-        }
+def load_failed_ids(path=FAILED_FILENAME):
+    """Load the dead-letter set of message (or thread) IDs that could not be fetched."""
+    if Path(path).exists():
+        try:
+            with open(path, 'rb') as f:
+                failed_ids = pickle.load(f)
+                if isinstance(failed_ids, set):
+                    return failed_ids
+        except (EOFError, pickle.UnpicklingError):
+            pass
+        print(f"Corrupted {path}, resetting...")
+    return set()
+
+def save_failed_ids(failed_ids, path=FAILED_FILENAME):
+    """Atomically persist the dead-letter set."""
+    temp_failed = f"{path}.tmp"
+    with open(temp_failed, 'wb') as f:
+        pickle.dump(failed_ids, f)
+    os.replace(temp_failed, path)
+
+def load_sync_state():
+    """Load listing/sync bookkeeping (history IDs) kept between runs."""
+    if Path(SYNC_STATE_FILENAME).exists():
+        try:
+            with open(SYNC_STATE_FILENAME, 'rb') as f:
+                state = pickle.load(f)
+                if isinstance(state, dict):
+                    return state
+        except (EOFError, pickle.UnpicklingError):
+            pass
+        print(f"Corrupted {SYNC_STATE_FILENAME}, resetting...")
+    return {}
+
+def save_sync_state(state):
+    """Atomically persist the sync bookkeeping."""
+    temp_state = f"{SYNC_STATE_FILENAME}.tmp"
+    with open(temp_state, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(temp_state, SYNC_STATE_FILENAME)
+
+class SenderTable:
+    """Sender aggregates in parallel array columns indexed by an interned sender ID.
+
+    ids maps each normalized (email, name) key to a dense integer ID, and
+    count, first_seen and last_seen (message dates in epoch milliseconds)
+    are int64 arrays indexed by it. Counting a message is an array
+    increment; timestamps are only formatted when rows are exported.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.count = array('q')
+        self.first_seen = array('q')
+        self.last_seen = array('q')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, seen, count=1, last_seen=None):
+        """Count messages from key dated between seen and last_seen (epoch ms)."""
+        last_seen = seen if last_seen is None else last_seen
+        sender_id = self.ids.get(key)
+        if sender_id is None:
+            sender_id = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.count.append(count)
+            self.first_seen.append(seen)
+            self.last_seen.append(last_seen)
+            return
+        self.count[sender_id] += count
+        if seen < self.first_seen[sender_id]:
+            self.first_seen[sender_id] = seen
+        if last_seen > self.last_seen[sender_id]:
+            self.last_seen[sender_id] = last_seen
+
+    def row(self, sender_id):
+        """Return (name, email, count, first_seen, last_seen) for one sender."""
+        email, name = self.keys[sender_id]
+        return (name, email, self.count[sender_id],
+                self.first_seen[sender_id], self.last_seen[sender_id])
+
+    def rows(self, sender_ids=None):
+        for sender_id in range(len(self.keys)) if sender_ids is None else sender_ids:
+            yield self.row(sender_id)
+
+def format_seen(millis):
+    """Format epoch milliseconds as the local ISO timestamp used in the CSV."""
+    return datetime.fromtimestamp(millis // 1000).isoformat()
+
+def parse_seen(value):
+    """Return epoch milliseconds for an ISO timestamp, passing integers through."""
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    return int(value)
+
+def sender_key(sender_name, sender_email):
+    """Return the (email, name) key that sender aggregates are grouped by."""
+    return (sender_email.strip().lower(), sender_name.strip().lower() if sender_name else "Unknown")
+
+def update_csv_data(csv_data, sender_name, sender_email, seen=None):
+    """Count one message from a sender, dated seen in epoch ms (default now)."""
+    csv_data.add(sender_key(sender_name, sender_email),
+                 int(time.time() * 1000) if seen is None else seen)
     return csv_data
 
+class FactStore:
+    """Columnar per-message facts, so aggregates can be rebuilt without refetching.
+
+    Each column is a file of fixed-width little-endian values in FACTS_DIR,
+    and row i of every column describes the same message. Raw From headers
+    are interned in senders.jsonl (the line number is the sender ID) and
+    label IDs in labels.json (the position is the bit in the labels mask).
+    """
+
+    def __init__(self, path=FACTS_DIR):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True)
+        self.pending = {name: array(code) for name, code in FACT_COLUMNS}
+        self.senders = []
+        self.sender_ids = {}
+        self.new_senders = []
+        self.labels = []
+        self.labels_changed = False
+        self.load_dictionaries()
+        self.rows = self.repair()
+
+    def load_dictionaries(self):
+        senders_path = self.path / FACT_SENDERS_FILENAME
+        if senders_path.exists():
+            good_offset = 0
+            with open(senders_path, 'rb') as f:
+                for line in f:
+                    try:
+                        sender = json.loads(line)
+                    except ValueError:
+                        print(f"Ignoring torn record at the end of {senders_path}")
+                        break
+                    good_offset += len(line)
+                    self.sender_ids[sender] = len(self.senders)
+                    self.senders.append(sender)
+            os.truncate(senders_path, good_offset)
+        labels_path = self.path / FACT_LABELS_FILENAME
+        if labels_path.exists():
+            with open(labels_path, 'r', encoding='utf-8') as f:
+                self.labels = json.load(f)
+        self.label_bits = {label: bit for bit, label in enumerate(self.labels)}
+
+    def repair(self):
+        """Cut every column back to the rows that all of them hold, dropping torn appends."""
+        paths = [(self.path / f"{name}.col", array(code).itemsize) for name, code in FACT_COLUMNS]
+        rows = min(path.stat().st_size // itemsize if path.exists() else 0
+                   for path, itemsize in paths)
+        for path, itemsize in paths:
+            if path.exists():
+                os.truncate(path, rows * itemsize)
+        return rows
+
+    def intern_sender(self, sender):
+        sender_id = self.sender_ids.get(sender)
+        if sender_id is None:
+            sender_id = self.sender_ids[sender] = len(self.senders)
+            self.senders.append(sender)
+            self.new_senders.append(sender)
+        return sender_id
+
+    def label_mask(self, label_ids):
+        mask = 0
+        for label in label_ids:
+            if label not in self.label_bits and len(self.labels) < LABEL_BITS - 1:
+                self.label_bits[label] = len(self.labels)
+                self.labels.append(label)
+                self.labels_changed = True
+            # Labels beyond the first 63 share the last bit
+            mask |= 1 << self.label_bits.get(label, LABEL_BITS - 1)
+        return mask
+
+    def append(self, msg_id, sender, facts):
+        internal_date, size_estimate, label_ids = facts
+        self.pending['msg_id'].append(int(msg_id, 16))
+        self.pending['sender'].append(self.intern_sender(sender))
+        self.pending['internal_date'].append(internal_date)
+        self.pending['size_estimate'].append(size_estimate)
+        self.pending['labels'].append(self.label_mask(label_ids))
+        if len(self.pending['msg_id']) >= FACTS_FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        """Append pending rows, writing the dictionaries they refer to first."""
+        if self.new_senders:
+            with open(self.path / FACT_SENDERS_FILENAME, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(sender) + '\n' for sender in self.new_senders)
+                f.flush()
+                os.fsync(f.fileno())
+            self.new_senders = []
+        if self.labels_changed:
+            labels_path = self.path / FACT_LABELS_FILENAME
+            temp_labels = f"{labels_path}.tmp"
+            with open(temp_labels, 'w', encoding='utf-8') as f:
+                json.dump(self.labels, f)
+            os.replace(temp_labels, labels_path)
+            self.labels_changed = False
+        for name, column in self.pending.items():
+            if not column:
+                continue
+            if sys.byteorder != 'little':
+                column.byteswap()
+            with open(self.path / f"{name}.col", 'ab') as f:
+                f.write(column.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self.rows += len(self.pending['msg_id'])
+        self.pending = {name: array(code) for name, code in FACT_COLUMNS}
+
+    def read_column(self, name):
+        """Load a whole column into an array."""
+        self.flush()
+        code = dict(FACT_COLUMNS)[name]
+        column = array(code)
+        path = self.path / f"{name}.col"
+        if path.exists():
+            with open(path, 'rb') as f:
+                column.fromfile(f, self.rows)
+            if sys.byteorder != 'little':
+                column.byteswap()
+        return column
+
+def reaggregate(facts):
+    """Rebuild the sender aggregate from local facts.
+
+    A message recorded twice (after a crash) counts once, and each
+    distinct From header is parsed once.
+    Returns (csv_data, number of messages).
+    """
+    latest = {}
+    for row, msg_id in enumerate(facts.read_column('msg_id')):
+        latest[msg_id] = row
+    senders = facts.read_column('sender')
+    dates = facts.read_column('internal_date')
+
+    names, emails = extract_senders_batch(facts.senders)
+    csv_data = SenderTable()
+    for row in sorted(latest.values(), key=dates.__getitem__):
+        sender_id = senders[row]
+        sender_name, sender_email = names[sender_id], emails[sender_id]
+        if sender_email:
+            csv_data = update_csv_data(csv_data, sender_name, sender_email, dates[row])
+    return csv_data, len(latest)
+
+class FileStore:
+    """Default state: processed_ids.bin, email_analysis.csv and its write-ahead log.
+
+    Pass the fact store to have its rows flushed before the log is, so no
+    logged message is missing from the facts.
+    """
+
+    def __init__(self, facts=None):
+        self.processed_ids, self.csv_data = load_processed_data(facts.senders if facts else ())
+        self.checkpoint = load_checkpoint()
+        self.analyses = {}
+        self.analysis_folded_seq = {}
+
+        # Recover work logged since the last checkpoint, including after a crash
+        self.log = AnalysisLog(before_sync=facts.flush if facts else None)
+        csv_folded_seq = folded_seq(self.checkpoint, CSV_FILENAME,
+                                    self.checkpoint and self.checkpoint['csv_sha256'])
+        for record in self.log.replay(csv_folded_seq):
+            seq, msg_id, sender_email, sender_name, seen, analyses = record
+            if seq > csv_folded_seq:
+                self.processed_ids.add(msg_id)
+                if sender_email:
+                    # Older logs hold raw names and ISO timestamps
+                    sender_name = normalize_display_name(sender_name) if sender_name else None
+                    self.csv_data = update_csv_data(self.csv_data, sender_name, sender_email,
+                                                    parse_seen(seen))
+            for name, values in analyses.items():
+                counts = self.analysis(name)
+                if seq > self.analysis_folded_seq[name]:
+                    counts.update(values)
+
+    def analysis(self, name):
+        """Return the counts of an analysis, starting from its export on first use."""
+        counts = self.analyses.get(name)
+        if counts is None:
+            _, column, filename, _ = ANALYZERS[name]
+            counts = self.analyses[name] = read_counts(filename, column)
+            digests = self.checkpoint.get('analysis_sha256', {}) if self.checkpoint else {}
+            self.analysis_folded_seq[name] = folded_seq(self.checkpoint, filename,
+                                                        digests.get(name))
+        return counts
+
+    def __contains__(self, msg_id):
+        return msg_id in self.processed_ids
+
+    def record(self, msg_id, sender_name, sender_email, seen, analyses=None):
+        self.record_page([(msg_id, sender_name, sender_email, seen, analyses)])
+
+    def record_page(self, records):
+        """Record a page of (msg_id, name, email, seen, analyses) results."""
+        for msg_id, sender_name, sender_email, seen, analyses in records:
+            self.log.append(msg_id, sender_email, sender_name, seen, analyses)
+
+            # Track emails based on email address
+            if sender_email:
+                self.csv_data = update_csv_data(self.csv_data, sender_name, sender_email, seen)
+            for name, values in (analyses or {}).items():
+                self.analysis(name).update(values)
+
+            self.processed_ids.add(msg_id)
+        if checkpoint_due(self.log, self.csv_data):
+            # Listers may still be reading processed_ids, so leave its base file alone
+            save_data(self.processed_ids, self.csv_data, self.log, compact_ids=False,
+                      analyses=self.analyses)
+
+    def sender_count(self):
+        return len(self.csv_data)
+
+    def processed_count(self):
+        return len(self.processed_ids)
+
+    def replace_senders(self, csv_data, analyses=None):
+        """Swap in rebuilt sender and analysis counts, folding the log so it is not replayed on top."""
+        self.csv_data = csv_data
+        self.analyses.update(analyses or {})
+        save_data(self.processed_ids, self.csv_data, self.log, analyses=self.analyses)
+
+    def top_senders(self, limit):
+        count = self.csv_data.count
+        top = sorted(range(len(count)), key=count.__getitem__, reverse=True)[:limit]
+        return list(self.csv_data.rows(top))
+
+    def senders_at(self, domain):
+        domain = domain.strip().lower()
+        rows = [row for row in self.csv_data.rows() if row[1].rpartition('@')[2] == domain]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def export(self):
+        if self.log.records:
+            save_data(self.processed_ids, self.csv_data, self.log, analyses=self.analyses)
+        self.log.close()
+
+    def flush(self):
+        """Sync the log and the new IDs; record() and export() fold the log."""
+        self.log.sync()
+        self.processed_ids.save()
+
+    def close(self):
+        if self.log.records:
+            print(f"{self.log.records} recent messages are kept in {WAL_FILENAME}; "
+                  f"run --export-only to fold them into {CSV_FILENAME}")
+        self.log.close()
+
+class SqliteStore:
+    """Processed IDs, per-message facts and sender aggregates in one SQLite database.
+
+    The database runs in WAL mode. Results are buffered and written as
+    batched UPSERTs in one transaction per DB_COMMIT_RECORDS messages, so
+    a crash loses at most one uncommitted page. Senders are indexed by
+    email (the primary key), domain and count, and the CSV is written
+    only on export. Analysis counts are upserted in the same transactions,
+    and their CSVs are written when the store is closed.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            msg_id TEXT PRIMARY KEY,
+            sender_email TEXT,
+            sender_name TEXT,
+            internal_date INTEGER
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS senders (
+            email TEXT NOT NULL,
+            name TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_seen INTEGER NOT NULL,  -- message dates, epoch ms
+            last_seen INTEGER NOT NULL,
+            PRIMARY KEY (email, name)
+        );
+        CREATE INDEX IF NOT EXISTS senders_domain ON senders (domain);
+        CREATE INDEX IF NOT EXISTS senders_count ON senders (count);
+        CREATE TABLE IF NOT EXISTS analyses (
+            analysis TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (analysis, value)
+        ) WITHOUT ROWID;
+    """
+    UPSERT_SENDER = """
+        INSERT INTO senders (email, name, domain, count, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (email, name) DO UPDATE SET
+            count = count + excluded.count,
+            first_seen = min(first_seen, excluded.first_seen),
+            last_seen = max(last_seen, excluded.last_seen)
+    """
+    UPSERT_ANALYSIS = """
+        INSERT INTO analyses (analysis, value, count) VALUES (?, ?, ?)
+        ON CONFLICT (analysis, value) DO UPDATE SET count = count + excluded.count
+    """
+
+    def __init__(self, path=DB_FILENAME, facts=None):
+        self.path = path
+        self.facts = facts
+        self.local = threading.local()
+        is_new = not Path(path).exists()
+        self.conn = self.local.conn = self.connect()
+        self.conn.executescript(self.SCHEMA)
+        self.pending = []
+        self.pending_ids = set()
+        self.analyses_used = set()
+        if is_new and (Path(CSV_FILENAME).exists() or Path(IDS_FILENAME).exists()
+                       or Path(PICKLE_FILENAME).exists()):
+            self.import_file_store()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def import_file_store(self):
+        """Seed a new database from the processed IDs and CSV of the default store."""
+        print(f"Importing existing {CSV_FILENAME} state into {self.path}...")
+        store = FileStore(self.facts)
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO messages (msg_id) VALUES (?)',
+                                  ((msg_id,) for msg_id in store.processed_ids))
+            self.conn.executemany(self.UPSERT_SENDER, (
+                (email, name, email.rpartition('@')[2], count, first_seen, last_seen)
+                for name, email, count, first_seen, last_seen in store.csv_data.rows()))
+        store.log.close()
+        store.processed_ids.close()
+
+    def __contains__(self, msg_id):
+        if msg_id in self.pending_ids:
+            return True
+        # Listers look IDs up from their own threads, and connections are per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn.execute('SELECT 1 FROM messages WHERE msg_id = ?',
+                            (msg_id,)).fetchone() is not None
+
+    def record(self, msg_id, sender_name, sender_email, seen, analyses=None):
+        self.record_page([(msg_id, sender_name, sender_email, seen, analyses)])
+
+    def record_page(self, records):
+        """Buffer a page of (msg_id, name, email, seen, analyses) results."""
+        for record in records:
+            if record[0] not in self.pending_ids:
+                self.pending.append(record)
+                self.pending_ids.add(record[0])
+        if len(self.pending) >= DB_COMMIT_RECORDS:
+            self.flush()
+
+    def flush(self):
+        """Write buffered results in a single transaction."""
+        if not self.pending:
+            return
+        # Fact rows go first, so no committed message is missing from the facts
+        if self.facts:
+            self.facts.flush()
+        senders = {}
+        analysis_counts = Counter()
+        for msg_id, sender_name, sender_email, seen, analyses in self.pending:
+            for name, values in (analyses or {}).items():
+                analysis_counts.update((name, value) for value in values)
+            if not sender_email:
+                continue
+            key = sender_key(sender_name, sender_email)
+            if key in senders:
+                count, first_seen, last_seen = senders[key]
+                senders[key] = (count + 1, min(first_seen, seen), max(last_seen, seen))
+            else:
+                senders[key] = (1, seen, seen)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO messages (msg_id, sender_email, sender_name, internal_date) '
+                'VALUES (?, ?, ?, ?)',
+                ((msg_id, sender_email, sender_name, seen)
+                 for msg_id, sender_name, sender_email, seen, _ in self.pending))
+            self.conn.executemany(self.UPSERT_SENDER, (
+                (email, name, email.rpartition('@')[2], count, first_seen, last_seen)
+                for (email, name), (count, first_seen, last_seen) in senders.items()))
+            for name in {name for name, _ in analysis_counts} - self.analyses_used:
+                self.import_analysis(name)
+            self.conn.executemany(self.UPSERT_ANALYSIS, (
+                (name, value, count) for (name, value), count in analysis_counts.items()))
+        self.pending = []
+        self.pending_ids = set()
+
+    def import_analysis(self, name):
+        """Seed an analysis the database has no counts for from its CSV export."""
+        self.analyses_used.add(name)
+        if self.conn.execute('SELECT 1 FROM analyses WHERE analysis = ? LIMIT 1',
+                             (name,)).fetchone() is None:
+            _, column, filename, _ = ANALYZERS[name]
+            self.conn.executemany(self.UPSERT_ANALYSIS, (
+                (name, value, count) for value, count in read_counts(filename, column).items()))
+
+    def export_analyses(self, names):
+        for name in names:
+            _, column, filename, _ = ANALYZERS[name]
+            export_counts(filename, column, self.conn.execute(
+                'SELECT value, count FROM analyses WHERE analysis = ? ORDER BY count DESC',
+                (name,)))
+
+    def sender_count(self):
+        return self.conn.execute('SELECT count(*) FROM senders').fetchone()[0]
+
+    def processed_count(self):
+        self.flush()
+        return self.conn.execute('SELECT count(*) FROM messages').fetchone()[0]
+
+    def replace_senders(self, csv_data, analyses=None):
+        self.flush()
+        with self.conn:
+            self.conn.execute('DELETE FROM senders')
+            self.conn.executemany(self.UPSERT_SENDER, (
+                (email, name, email.rpartition('@')[2], count, first_seen, last_seen)
+                for name, email, count, first_seen, last_seen in csv_data.rows()))
+            for name, counts in (analyses or {}).items():
+                self.analyses_used.add(name)
+                self.conn.execute('DELETE FROM analyses WHERE analysis = ?', (name,))
+                self.conn.executemany(self.UPSERT_ANALYSIS, (
+                    (name, value, count) for value, count in counts.items()))
+
+    def top_senders(self, limit):
+        return self.conn.execute(
+            'SELECT name, email, count, first_seen, last_seen FROM senders '
+            'ORDER BY count DESC LIMIT ?', (limit,)).fetchall()
+
+    def senders_at(self, domain):
+        return self.conn.execute(
+            'SELECT name, email, count, first_seen, last_seen FROM senders '
+            'WHERE domain = ? ORDER BY count DESC', (domain.strip().lower(),)).fetchall()
+
+    def export(self):
+        temp_csv = f"{CSV_FILENAME}.tmp"
+        write_csv(temp_csv, self.conn.execute(
+            'SELECT name, email, count, first_seen, last_seen FROM senders ORDER BY count DESC'))
+        os.replace(temp_csv, CSV_FILENAME)
+        self.export_analyses([name for name, in self.conn.execute(
+            'SELECT DISTINCT analysis FROM analyses') if name in ANALYZERS])
+        self.conn.close()
+
+    def close(self):
+        self.flush()
+        self.export_analyses(sorted(self.analyses_used))
+        self.conn.close()
+
+def print_senders(rows):
+    for name, email, count, first_seen, last_seen in rows:
+        print(f"{count:>8}  {email}  ({name})  {format_seen(first_seen)} .. {format_seen(last_seen)}")
+
 def main():
     parser = argparse.ArgumentParser(description='Gmail Account Analyzer')
     parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
                        help='Number of emails to process per run')
     parser.add_argument('--export-only', action='store_true',
                        help='Export existing CSV without processing')
+    parser.add_argument('--fetch-mode', choices=['single', 'batch', 'async'], default='single',
+                       help='Fetch messages one request at a time, through the batch endpoint, '
+                            'or concurrently on an asyncio event loop')
+    parser.add_argument('--unit', choices=['messages', 'threads'], default='messages',
+                       help='List and fetch individual messages, or whole threads in one call each')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of concurrent fetch threads')
+    parser.add_argument('--max-in-flight', type=int, default=ASYNC_MAX_IN_FLIGHT,
+                       help='Maximum concurrent requests in async fetch mode')
+    parser.add_argument('--api-root', default=GMAIL_API_ROOT,
+                       help='Gmail REST API root used by async fetch mode')
+    parser.add_argument('--retry-failed', action='store_true',
+                       help='Re-fetch only messages in the dead-letter set')
+    parser.add_argument('--incremental', action='store_true',
+                       help='Only fetch messages added since the last completed scan (History API)')
+    parser.add_argument('--sharded-backfill', action='store_true',
+                       help='List date windows of the mailbox concurrently during a full scan')
+    parser.add_argument('--listers', type=int, default=SHARD_LISTERS,
+                       help='Number of concurrent date-window listers for --sharded-backfill')
+    parser.add_argument('--since', default=GMAIL_LAUNCH_DATE,
+                       help='Earliest date (YYYY-MM-DD) to split into windows for --sharded-backfill')
+    parser.add_argument('--quota-rate', type=int, default=QUOTA_UNITS_PER_SECOND,
+                       help='Gmail quota units to spend per second (0 disables throttling)')
+    parser.add_argument('--analyze', default='', metavar='NAMES',
+                       help='Comma-separated extra analyses in the same pass: '
+                            + ', '.join(ANALYZERS))
+    parser.add_argument('--store', choices=['file', 'sqlite'], default='file',
+                       help='Keep state in processed_ids.bin and the CSV, or in one SQLite database')
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_MB, metavar='MB',
+                       help='Size cap of the raw metadata cache (0 disables it)')
+    parser.add_argument('--cache-only', action='store_true',
+                       help='Analyze cached messages only, without contacting Gmail')
+    parser.add_argument('--reanalyze', action='store_true',
+                       help='Make --cache-only rebuild sender stats and analyses from every '
+                            'cached processed message')
+    parser.add_argument('--allow-uncached', action='store_true',
+                       help='Let --reanalyze drop processed messages that are not cached')
+    parser.add_argument('--sender-memo-size', type=int, default=SENDER_MEMO_SIZE, metavar='N',
+                       help='Distinct From headers to keep parsed in memory (0 disables)')
+    parser.add_argument('--persist-sender-memo', action='store_true',
+                       help=f'Keep the parsed From headers in {SENDER_MEMO_FILENAME} between runs')
+    parser.add_argument('--reaggregate', action='store_true',
+                       help='Rebuild sender stats from the local fact store without fetching')
+    parser.add_argument('--allow-missing-facts', action='store_true',
+                       help='Let --reaggregate drop processed messages that have no facts')
+    parser.add_argument('--top', type=int, metavar='N',
+                       help='Print the N most frequent senders without processing')
+    parser.add_argument('--domain',
+                       help='Print all senders at a domain without processing')
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and args.fetch_mode == 'async':
+        parser.error('--workers does not apply to --fetch-mode async')
+    if args.incremental and args.retry_failed:
+        parser.error('--incremental cannot be combined with --retry-failed')
+    if args.sharded_backfill and args.fetch_mode == 'async':
+        parser.error('--sharded-backfill does not apply to --fetch-mode async')
+    if args.listers < 1:
+        parser.error('--listers must be at least 1')
+    if args.cache_only and args.cache_size <= 0:
+        parser.error('--cache-only needs the cache; --cache-size must be positive')
+    if args.cache_only and (args.incremental or args.retry_failed or args.sharded_backfill):
+        parser.error('--cache-only cannot be combined with --incremental, --retry-failed '
+                     'or --sharded-backfill')
+    if (args.reanalyze or args.allow_uncached) and not args.cache_only:
+        parser.error('--reanalyze and --allow-uncached only apply to --cache-only')
+    if args.unit == 'threads' and args.fetch_mode != 'single':
+        parser.error('--unit threads only supports --fetch-mode single')
+    if args.unit == 'threads' and (args.incremental or args.sharded_backfill or args.cache_only):
+        parser.error('--unit threads cannot be combined with --incremental, '
+                     '--sharded-backfill or --cache-only')
+    analyzer_names = [name.strip() for name in args.analyze.split(',') if name.strip()]
+    unknown_analyzers = set(analyzer_names) - set(ANALYZERS)
+    if unknown_analyzers:
+        parser.error(f"unknown analyses: {', '.join(sorted(unknown_analyzers))}")
+    if args.fetch_mode == 'async' and aiohttp is None:
+        parser.error("--fetch-mode async requires the 'aiohttp' package")
 
-    processed_ids, csv_data = load_processed_data()
+    facts = FactStore()
+    store = SqliteStore(facts=facts) if args.store == 'sqlite' else FileStore(facts)
+    failed_ids = load_failed_ids()
+    failed_thread_ids = load_failed_ids(FAILED_THREADS_FILENAME)
+    sync_state = load_sync_state()
 
-    if args.export_only:
-        print(f"Current CSV contains {len(csv_data)} entries")
+    if args.reaggregate:
+        csv_data, fact_messages = reaggregate(facts)
+        missing = store.processed_count() - fact_messages
+        if missing > 0 and not args.allow_missing_facts:
+            # Replacing the aggregate would drop these messages for good
+            print(f"{missing} processed messages have no facts (they predate the fact store); "
+                  f"the sender stats were left unchanged. Rerun with --allow-missing-facts "
+                  f"to rebuild without them.")
+            store.close()
+            return
+        store.replace_senders(csv_data)
+        for rollup in load_rollups(store):
+            rollup.export()
+        print(f"Rebuilt {len(csv_data)} senders from {fact_messages} messages")
+        if missing > 0:
+            print(f"{missing} processed messages predate the fact store and are not included")
+        store.close()
         return
 
-    service = get_gmail_service()
-    if not service:
+    if args.top is not None or args.domain:
+        if args.top is not None:
+            print_senders(store.top_senders(args.top))
+        if args.domain:
+            print_senders(store.senders_at(args.domain))
+        store.close()
         return
 
-    total_processed = 0
-    page_token = None
+    if args.export_only:
+        total_senders = store.sender_count()
+        for rollup in load_rollups(store):
+            rollup.export()
+        store.export()
+        print(f"Current CSV contains {total_senders} entries")
+        if failed_ids:
+            print(f"{len(failed_ids)} messages failed to fetch; rerun with --retry-failed")
+        if failed_thread_ids:
+            print(f"{len(failed_thread_ids)} threads failed to fetch; "
+                  f"rerun with --unit threads --retry-failed")
+        return
 
-    try:
-        while total_processed < args.batch_size:
-            messages, page_token = get_messages(service, page_token=page_token)
-            if not messages:
-                break
+    analyzers = [HeaderAnalyzer(name) for name in dict.fromkeys(analyzer_names)]
+    rollups = load_rollups(store)
+    # One fetch per message serves every analyzer
+    metadata_request.configure(analyzers)
+    message_cache.configure(args.cache_size * 1024 * 1024)
+    sender_memo.configure(args.sender_memo_size,
+                          SENDER_MEMO_FILENAME if args.persist_sender_memo else None)
+    if not args.cache_only:
+        creds = get_credentials()
+        if not creds:
+            store.close()
+            return
+        quota_limiter.configure(args.quota_rate)
+        service = get_gmail_service(creds)
+        if not service:
+            store.close()
+            return
 
-            for message in messages:
-                if total_processed >= args.batch_size:
-                    break
+    total_processed = 0
+    controller = None
+    # Thread listings page differently, so they keep their own position
+    cursor_key = 'thread_cursor' if args.unit == 'threads' else 'cursor'
+    cursor = None
+    shards = None
+    thread_failures = set()
+    fetched_threads = {}
+    # historyId of every thread recorded by a thread scan, changed by new replies
+    thread_history = sync_state.setdefault('thread_history', {})
 
-                msg_id = message['id']
-                if msg_id in processed_ids:
-                    continue
+    def is_known(msg_id):
+        # Dead-lettered threads are skipped by skip_thread; a message that shares
+        # its ID with one (the thread's first message) is still new
+        return msg_id in store or msg_id in failed_ids
 
-                sender_name, sender_email, sender_header = analyze_message(service, 'me', msg_id)
-                reason = []
-                if not sender_email:
-                    reason.append('missing email')
+    def skip_thread(thread):
+        # Threads changed since they were recorded are fetched again for their new messages
+        thread_id = thread['id']
+        return thread_id in failed_thread_ids or (
+            thread_id in thread_history and thread_history[thread_id] == thread.get('historyId'))
 
-                # Track emails based on email address
+    def record_page(results):
+        nonlocal total_processed
+        records = []
+        for msg_id, sender_name, sender_email, sender_header, message in results:
+            if message is MESSAGE_GONE:
+                # Deleted since it was listed; there is nothing to count or retry
+                failed_ids.discard(msg_id)
+                failed_thread_ids.discard(msg_id)
+            # A missing header means the fetch failed after all retries
+            elif sender_header is None:
+                if args.unit == 'threads':
+                    # The ID is a thread's; retrying it with messages.get would miss replies
+                    failed_thread_ids.add(msg_id)
+                    thread_failures.add(msg_id)
+                else:
+                    failed_ids.add(msg_id)
+            else:
+                failed_ids.discard(msg_id)
+                metadata = message_facts(message)
+                facts.append(msg_id, sender_header, metadata)
+                analyses = {}
+                for analyzer in analyzers:
+                    values = analyzer.values(message)
+                    if values:
+                        analyses[analyzer.name] = values
+                # First/last seen track when mail arrived, not when it was analyzed
+                internal_date = metadata[0] or int(time.time() * 1000)
+                records.append((msg_id, sender_name, sender_email, internal_date, analyses))
                 if sender_email:
-                    csv_data = update_csv_data(csv_data, sender_name, sender_email)
+                    for rollup in rollups:
+                        rollup.add(sender_email)
+        store.record_page(records)
+        total_processed += len(records)
 
-                processed_ids.add(msg_id)
-                total_processed += 1
+        # Only release the listing positions once the page is recorded
+        for msg_id, *_ in results:
+            if cursor:
+                cursor.complete(msg_id)
+            if shards:
+                shards.complete(msg_id)
 
-            if not page_token:
-                break
+    try:
+        if args.reanalyze:
+            csv_data, analysis_counts, cached_messages = reanalyze_cached(
+                store.__contains__, analyzers)
+            missing = store.processed_count() - cached_messages
+            if missing > 0 and not args.allow_uncached:
+                # Replacing the aggregate would drop these messages for good
+                print(f"{missing} processed messages are not cached (they were evicted or "
+                      f"predate the cache); the sender stats were left unchanged. Rerun "
+                      f"with --allow-uncached to rebuild without them.")
+                return
+            store.replace_senders(csv_data, analysis_counts)
+            senders = store.top_senders(store.sender_count())
+            for rollup in rollups:
+                rollup.load(senders)
+            print(f"Rebuilt {len(csv_data)} senders from {cached_messages} cached messages")
+            if missing > 0:
+                print(f"{missing} processed messages are not cached and are not included")
+            return
+
+        if args.cache_only:
+            print(f"Analyzing up to {args.batch_size} of {len(message_cache)} cached messages offline")
+            analyze_cached(is_known, record_page, args.batch_size)
+            return
+
+        msg_ids = None
+        if args.retry_failed:
+            msg_ids = sorted(failed_thread_ids if args.unit == 'threads' else failed_ids)
+        new_history_id = None
+        if args.incremental and 'history_id' not in sync_state:
+            print("No completed scan recorded yet, running a full listing")
+        elif args.incremental:
+            try:
+                added, latest_history_id = get_history_changes(service, 'me', sync_state['history_id'])
+            except Exception as error:
+                print(f"Error retrieving mailbox history: {error}")
+                return
+            if added is None:
+                print("History ID expired, falling back to a full listing")
+                del sync_state['history_id']
+            else:
+                msg_ids = [msg_id for msg_id in added if not is_known(msg_id)]
+                # Only advance past changes that fit into this run
+                if len(msg_ids) <= args.batch_size:
+                    new_history_id = latest_history_id
+
+        # The history ID at the start of a full scan becomes the incremental
+        # starting point once the scan has listed the whole mailbox.
+        if msg_ids is None and 'scan_history_id' not in sync_state:
+            scan_history_id = get_current_history_id(service)
+            if scan_history_id:
+                sync_state['scan_history_id'] = scan_history_id
+
+        listing = {}
+        if msg_ids is None and args.sharded_backfill:
+            if 'shards' not in sync_state:
+                since = int(datetime.strptime(args.since, '%Y-%m-%d')
+                            .replace(tzinfo=timezone.utc).timestamp())
+                print("Planning date windows for the backfill...")
+                try:
+                    sync_state['shards'] = plan_shards(service, 'me', since,
+                                                       int(time.time()) + 86400)
+                except Exception as error:
+                    print(f"Error planning date windows: {error}")
+                    return
+            shards = ShardSet(sync_state['shards'], args.batch_size)
+        elif msg_ids is None:
+            cursor = ListingCursor(sync_state.get(cursor_key))
+        if args.fetch_mode == 'async':
+            controller = asyncio.run(run_async_engine(creds, 'me', is_known, record_page,
+                                                      args.batch_size, args.api_root,
+                                                      args.max_in_flight, msg_ids, listing,
+                                                      cursor))
+        else:
+            fetch_mode = 'threads' if args.unit == 'threads' else args.fetch_mode
+            controller = run_pipeline(creds, 'me', is_known, record_page, args.batch_size,
+                                      fetch_mode, args.workers, msg_ids, listing, cursor,
+                                      shards, args.listers,
+                                      skip_thread if args.unit == 'threads' else None,
+                                      fetched_threads)
+            if args.retry_failed and args.unit == 'threads':
+                # Retried threads that did not fail again have all their messages recorded
+                failed_thread_ids.difference_update(
+                    set(msg_ids[:args.batch_size]) - thread_failures)
+
+        if new_history_id:
+            sync_state['history_id'] = new_history_id
+        elif listing.get('complete') and 'scan_history_id' in sync_state:
+            sync_state['history_id'] = sync_state.pop('scan_history_id')
 
     except KeyboardInterrupt:
         print("\nOperation interrupted by user")
     finally:
-        save_data(processed_ids, csv_data)
-        print(f"Processed {total_processed} new emails. Total unique senders: {len(csv_data)}")
+        for thread_id, (history_id, new_ids) in fetched_threads.items():
+            # Skip the thread until it changes, once all its new messages are recorded
+            if all(msg_id in store for msg_id in new_ids):
+                thread_history[thread_id] = history_id
+        if cursor:
+            # Resume the next backfill run where this one left off
+            position = cursor.position()
+            if position is None:
+                sync_state.pop(cursor_key, None)
+            else:
+                sync_state[cursor_key] = position
+        if shards:
+            remaining_shards = shards.snapshot()
+            if remaining_shards:
+                sync_state['shards'] = remaining_shards
+            else:
+                sync_state.pop('shards', None)
+        message_cache.close()
+        sender_memo.close()
+        for rollup in rollups:
+            rollup.export()
+        # Facts go first, so every recorded message has its row
+        facts.flush()
+        store.flush()
+        total_senders = store.sender_count()
+        store.close()
+        save_failed_ids(failed_ids)
+        save_failed_ids(failed_thread_ids, FAILED_THREADS_FILENAME)
+        save_sync_state(sync_state)
+        print(f"Processed {total_processed} new emails. Total unique senders: {total_senders}")
+        if failed_ids:
+            print(f"{len(failed_ids)} messages in dead-letter set; rerun with --retry-failed")
+        if failed_thread_ids:
+            print(f"{len(failed_thread_ids)} threads in dead-letter set; "
+                  f"rerun with --unit threads --retry-failed")
+        print(f"Quota units consumed: {quota_limiter.consumed}")
+        if message_cache.hits:
+            print(f"Messages served from the cache: {message_cache.hits}")
+        if sender_memo.hits or sender_memo.misses:
+            print(f"Sender memo: {sender_memo.hits} hits, {sender_memo.misses} misses, "
+                  f"{len(sender_memo.entries)} of {sender_memo.capacity} entries used")
+        if controller:
+            print(f"Adaptive concurrency limit at exit: {int(controller.limit)}")
 
 if __name__ == '__main__':
     main()
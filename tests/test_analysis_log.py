@@ -0,0 +1,133 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gmail_analyzer
+
+SEEN = 1600000000000
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    """Keep every state file of a test in its own directory."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def record_messages(store, start, count, sender_email='alice@example.com'):
+    for i in range(start, start + count):
+        store.record(f"{0x18c0000000000000 + i:x}", 'Alice', sender_email, SEEN + i)
+
+
+def sender_counts(store):
+    return {email: count for _, email, count, _, _ in store.top_senders(10)}
+
+
+def test_save_data_checkpoint_names_the_snapshot_and_truncates_the_log():
+    processed_ids, csv_data = gmail_analyzer.load_processed_data()
+    log = gmail_analyzer.AnalysisLog()
+    list(log.replay(0))
+    for i in range(3):
+        msg_id = f"{0x18c0000000000000 + i:x}"
+        log.append(msg_id, 'alice@example.com', 'Alice', SEEN + i)
+        gmail_analyzer.update_csv_data(csv_data, 'Alice', 'alice@example.com', SEEN + i)
+        processed_ids.add(msg_id)
+
+    gmail_analyzer.save_data(processed_ids, csv_data, log)
+
+    with open(gmail_analyzer.CHECKPOINT_FILENAME, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    assert checkpoint['seq'] == 3
+    assert checkpoint['previous_seq'] == 0
+    assert checkpoint['csv_sha256'] == gmail_analyzer.file_sha256(gmail_analyzer.CSV_FILENAME)
+    assert os.path.getsize(gmail_analyzer.WAL_FILENAME) == 0
+    assert log.folded_seq == 3 and log.records == 0
+    assert not Path(f"{gmail_analyzer.CSV_FILENAME}.tmp").exists()
+    log.close()
+    processed_ids.close()
+
+
+def test_folded_seq_falls_back_to_the_previous_checkpoint_for_an_old_snapshot():
+    Path('snapshot.csv').write_text('new', encoding='utf-8')
+    digest = gmail_analyzer.file_sha256('snapshot.csv')
+    checkpoint = {'seq': 7, 'previous_seq': 4, 'csv_sha256': digest}
+
+    assert gmail_analyzer.folded_seq(None, 'snapshot.csv', digest) == 0
+    assert gmail_analyzer.folded_seq(checkpoint, 'snapshot.csv', digest) == 7
+    assert gmail_analyzer.folded_seq(checkpoint, 'snapshot.csv', None) == 7
+    Path('snapshot.csv').write_text('old', encoding='utf-8')
+    assert gmail_analyzer.folded_seq(checkpoint, 'snapshot.csv', digest) == 4
+    assert gmail_analyzer.folded_seq(checkpoint, 'missing.csv', digest) == 4
+
+
+def test_replay_truncates_a_torn_record_and_continues_its_seq():
+    good = ''.join(json.dumps([seq, f"{seq:x}", 'alice@example.com', 'Alice', SEEN]) + '\n'
+                   for seq in (1, 2))
+    Path(gmail_analyzer.WAL_FILENAME).write_text(good + '[3, "3", "alice@exa', encoding='utf-8')
+
+    log = gmail_analyzer.AnalysisLog()
+    records = list(log.replay(0))
+
+    assert [record[0] for record in records] == [1, 2]
+    assert os.path.getsize(gmail_analyzer.WAL_FILENAME) == len(good.encode())
+    log.append('3', 'alice@example.com', 'Alice', SEEN)
+    log.close()
+    with open(gmail_analyzer.WAL_FILENAME, encoding='utf-8') as f:
+        assert [json.loads(line)[0] for line in f] == [1, 2, 3]
+
+
+def test_crash_between_checkpoint_and_csv_replace_replays_exactly_once(monkeypatch):
+    store = gmail_analyzer.FileStore()
+    record_messages(store, 0, 3)
+    store.export()
+    store.processed_ids.close()
+
+    store = gmail_analyzer.FileStore()
+    record_messages(store, 3, 2)
+    replace = os.replace
+
+    def crash_before_csv(src, dst):
+        if dst == gmail_analyzer.CSV_FILENAME:
+            raise OSError("crashed")
+        replace(src, dst)
+
+    monkeypatch.setattr(gmail_analyzer.os, 'replace', crash_before_csv)
+    with pytest.raises(OSError):
+        store.export()
+    monkeypatch.setattr(gmail_analyzer.os, 'replace', replace)
+    store.log.file.close()
+    store.processed_ids.close()
+
+    with open(gmail_analyzer.CHECKPOINT_FILENAME, encoding='utf-8') as f:
+        assert json.load(f)['seq'] == 5
+    store = gmail_analyzer.FileStore()
+    assert sender_counts(store) == {'alice@example.com': 5}
+    assert store.processed_count() == 5
+
+    store.export()
+    store.processed_ids.close()
+    store = gmail_analyzer.FileStore()
+    assert sender_counts(store) == {'alice@example.com': 5}
+    store.close()
+    store.processed_ids.close()
+
+
+def test_flush_keeps_a_short_run_in_the_log():
+    store = gmail_analyzer.FileStore()
+    record_messages(store, 0, 3)
+    store.flush()
+    store.close()
+    store.processed_ids.close()
+
+    assert not Path(gmail_analyzer.CHECKPOINT_FILENAME).exists()
+    with open(gmail_analyzer.WAL_FILENAME, encoding='utf-8') as f:
+        assert len(f.readlines()) == 3
+    store = gmail_analyzer.FileStore()
+    assert sender_counts(store) == {'alice@example.com': 3}
+    assert store.processed_count() == 3
+    store.close()
+    store.processed_ids.close()
@@ -0,0 +1,87 @@
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gmail_analyzer
+
+MESSAGE_IDS = [f"{0x18c0000000000000 + i * 7919:x}" for i in range(250)]
+SENDERS = ['Alice <alice@example.com>', '"Bob B" <bob@mail.example.co.uk>', 'noreply@shop.com']
+TOKEN = 'stand-in'
+
+
+@pytest.fixture(autouse=True)
+def unthrottled():
+    """Let the stand-in answer as fast as it can instead of at the Gmail quota rate."""
+    gmail_analyzer.quota_limiter.configure(0)
+    yield
+    gmail_analyzer.quota_limiter.configure(gmail_analyzer.QUOTA_UNITS_PER_SECOND)
+
+
+class StandInCredentials:
+    """Always-valid credentials that send a fixed bearer token."""
+    valid = True
+    refresh_token = None
+    token = TOKEN
+
+
+def stand_in_app(seen_tokens):
+    """Serve users.messages.list and users.messages.get like the Gmail REST API."""
+
+    async def list_messages(request):
+        seen_tokens.add(request.headers.get('Authorization'))
+        start = int(request.query.get('pageToken', 0))
+        end = min(start + int(request.query.get('maxResults', 100)), len(MESSAGE_IDS))
+        body = {'messages': [{'id': msg_id} for msg_id in MESSAGE_IDS[start:end]]}
+        if end < len(MESSAGE_IDS):
+            body['nextPageToken'] = str(end)
+        return web.json_response(body)
+
+    async def get_message(request):
+        seen_tokens.add(request.headers.get('Authorization'))
+        index = MESSAGE_IDS.index(request.match_info['id'])
+        return web.json_response({
+            'id': request.match_info['id'],
+            'internalDate': str(1600000000000 + index * 60000),
+            'payload': {'headers': [{'name': 'From', 'value': SENDERS[index % len(SENDERS)]}]},
+        })
+
+    app = web.Application()
+    app.add_routes([web.get('/users/me/messages', list_messages),
+                    web.get('/users/me/messages/{id}', get_message)])
+    return app
+
+
+async def run_against_stand_in(limit, processed_ids=(), seen_tokens=None):
+    runner = web.AppRunner(stand_in_app(set() if seen_tokens is None else seen_tokens))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    host, port = runner.addresses[0][:2]
+    results = {}
+    try:
+        await gmail_analyzer.run_async_engine(
+            StandInCredentials(), 'me', set(processed_ids).__contains__,
+            lambda page: results.update({msg_id: email for msg_id, _, email, *_ in page}),
+            limit, api_root=f"http://{host}:{port}", max_in_flight=8)
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def test_async_engine_against_stand_in():
+    seen_tokens = set()
+    results = asyncio.run(run_against_stand_in(1000, seen_tokens=seen_tokens))
+    assert sorted(results) == sorted(MESSAGE_IDS)
+    assert results[MESSAGE_IDS[0]] == 'alice@example.com'
+    assert results[MESSAGE_IDS[1]] == 'bob@mail.example.co.uk'
+    assert seen_tokens == {f"Bearer {TOKEN}"}
+
+
+def test_async_engine_skips_processed_and_stops_at_limit():
+    results = asyncio.run(run_against_stand_in(120, processed_ids=MESSAGE_IDS[:50]))
+    assert sorted(results) == sorted(MESSAGE_IDS[50:170])
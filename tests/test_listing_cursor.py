@@ -0,0 +1,74 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gmail_analyzer
+from gmail_analyzer import ListingCursor, find_resume_offset
+
+PAGES = {None: (['a', 'b', 'c'], 'p2'), 'p2': (['d', 'e', 'f'], None)}
+
+
+def list_page(service, user_id, page_token, query):
+    msg_ids, next_page_token = PAGES[page_token]
+    return [{'id': msg_id} for msg_id in msg_ids], next_page_token
+
+
+def listed(cursor):
+    return [(page_token, offset, [m['id'] for m in messages], next_page_token)
+            for page_token, offset, messages, next_page_token
+            in gmail_analyzer.iter_listing_pages(None, 'me', cursor, list_page=list_page)]
+
+
+def test_find_resume_offset_follows_a_shifted_page():
+    messages = [{'id': msg_id} for msg_id in ['x', 'a', 'b']]
+    assert find_resume_offset(messages, 2, 'b') == 2
+    assert find_resume_offset(messages, 1, 'b') == 2
+    assert find_resume_offset(messages, 1, 'gone') is None
+    assert find_resume_offset(messages, 3, None) == 3
+    assert find_resume_offset(messages, 4, None) is None
+
+
+def test_position_waits_for_the_earliest_outstanding_message():
+    cursor = ListingCursor()
+    messages = list_page(None, 'me', None, None)[0]
+    taken, page_done = gmail_analyzer.take_unlisted(
+        messages, None, 'p2', 0, lambda message: message['id'] == 'b', 5, cursor)
+    assert taken == ['a', 'c'] and page_done
+
+    cursor.complete('c')
+    assert cursor.position() == (None, 0, 'a')
+    cursor.complete('a')
+    assert cursor.position() == ('p2', 0, None)
+
+
+def test_take_unlisted_saves_where_room_ran_out():
+    cursor = ListingCursor()
+    messages = list_page(None, 'me', 'p2', None)[0]
+    taken, page_done = gmail_analyzer.take_unlisted(messages, 'p2', None, 0, lambda _: False,
+                                                    2, cursor)
+    assert taken == ['d', 'e'] and not page_done
+    for msg_id in taken:
+        cursor.complete(msg_id)
+    assert cursor.position() == ('p2', 2, 'f')
+
+
+def test_expanded_thread_completes_with_its_last_message():
+    cursor = ListingCursor()
+    cursor.dispatch('t1', (None, 0, 't1'))
+    cursor.advance(None)
+    cursor.expand('t1', ['m1', 'm2'])
+    cursor.complete('m1')
+    assert cursor.position() == (None, 0, 't1')
+    cursor.complete('m2')
+    assert cursor.position() is None
+
+
+def test_resume_starts_at_the_saved_message():
+    cursor = ListingCursor(('p2', 0, 'e'))
+    assert listed(cursor) == [('p2', 1, ['d', 'e', 'f'], None)]
+
+
+def test_stale_cursor_restarts_from_the_first_page(capsys):
+    cursor = ListingCursor(('p2', 1, 'gone'))
+    assert listed(cursor) == [(None, 0, ['a', 'b', 'c'], 'p2'), ('p2', 0, ['d', 'e', 'f'], None)]
+    assert "no longer valid" in capsys.readouterr().out
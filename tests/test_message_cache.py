@@ -0,0 +1,117 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gmail_analyzer
+
+HEADERS = ['From']
+FIELDS = ['id', 'payload']
+MESSAGE_IDS = [f"{0x18c0000000000000 + i * 7919:x}" for i in range(450)]
+
+
+def message(msg_id):
+    return {'id': msg_id, 'payload': {'headers': [{'name': 'From', 'value': f"{msg_id}@example.com"}]}}
+
+
+def open_cache(path, max_bytes=1 << 30, headers=HEADERS):
+    cache = gmail_analyzer.MessageCache()
+    cache.configure(max_bytes, headers=headers, fields=FIELDS, path=path)
+    return cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return tmp_path / 'message_cache'
+
+
+def fill(cache, msg_ids):
+    for msg_id in msg_ids:
+        cache.put(msg_id, message(msg_id))
+    cache.close()
+
+
+def test_reopened_cache_finds_indexed_and_later_blocks(cache_dir):
+    cache = open_cache(cache_dir)
+    fill(cache, MESSAGE_IDS[:250])
+    cache.rebuild_index()
+    cache.close_index()
+    cache = open_cache(cache_dir)
+    fill(cache, MESSAGE_IDS[250:])
+    cache.close_index()
+
+    cache = open_cache(cache_dir)
+    assert len(cache.keys) == 250
+    assert len(cache.recent) == 200
+    assert sorted(cache.ids()) == sorted(MESSAGE_IDS)
+    assert all(cache.get(msg_id) == message(msg_id) for msg_id in MESSAGE_IDS)
+    assert cache.get('18bfffffffffffff') is None
+    cache.close_index()
+
+
+@pytest.mark.parametrize('damage', ['delete', 'truncate'])
+def test_missing_or_damaged_index_is_rebuilt_from_the_blocks(cache_dir, damage):
+    cache = open_cache(cache_dir)
+    fill(cache, MESSAGE_IDS)
+    cache.rebuild_index()
+    cache.close_index()
+    index_path = cache_dir / gmail_analyzer.CACHE_INDEX_FILENAME
+    if damage == 'delete':
+        index_path.unlink()
+    else:
+        index_path.write_bytes(index_path.read_bytes()[:-5])
+
+    cache = open_cache(cache_dir)
+    assert len(cache.keys) == len(MESSAGE_IDS) and not cache.recent
+    assert all(cache.get(msg_id) == message(msg_id) for msg_id in MESSAGE_IDS)
+    cache.close_index()
+
+
+def test_torn_final_block_is_cut_off(cache_dir):
+    cache = open_cache(cache_dir)
+    fill(cache, MESSAGE_IDS[:100])
+    cache.close_index()
+    segment = cache.segments[-1]
+    intact = segment.stat().st_size
+    fill(open_cache(cache_dir), MESSAGE_IDS[100:200])
+    with open(segment, 'r+b') as f:
+        f.truncate(segment.stat().st_size - 10)
+
+    cache = open_cache(cache_dir)
+    assert segment.stat().st_size == intact
+    assert cache.get(MESSAGE_IDS[0]) == message(MESSAGE_IDS[0])
+    assert cache.get(MESSAGE_IDS[150]) is None
+    cache.close_index()
+
+
+def test_blocks_without_the_requested_headers_are_misses(cache_dir):
+    cache = open_cache(cache_dir)
+    fill(cache, MESSAGE_IDS[:100])
+    cache.close_index()
+
+    cache = open_cache(cache_dir, headers=HEADERS + ['Subject'])
+    assert cache.get(MESSAGE_IDS[0]) is None
+    assert cache.ids() == []
+    cache.close_index()
+
+
+def test_eviction_drops_the_oldest_segments(cache_dir, monkeypatch):
+    monkeypatch.setattr(gmail_analyzer, 'CACHE_INDEX_PENDING_LIMIT', 200)
+    max_bytes = 8000
+    cache = open_cache(cache_dir, max_bytes)
+    fill(cache, MESSAGE_IDS)
+
+    segments = sorted(cache_dir.glob('*.seg'))
+    assert sum(segment.stat().st_size for segment in segments[:-1]) <= max_bytes
+    assert cache.get(MESSAGE_IDS[0]) is None
+    assert cache.get(MESSAGE_IDS[-1]) == message(MESSAGE_IDS[-1])
+    kept = cache.ids()
+    assert MESSAGE_IDS[0] not in kept and MESSAGE_IDS[-1] in kept
+    cache.close_index()
+
+    cache = open_cache(cache_dir, max_bytes)
+    assert sorted(cache.ids()) == sorted(kept)
+    assert cache.get(MESSAGE_IDS[0]) is None
+    assert all(cache.get(msg_id) == message(msg_id) for msg_id in kept)
+    cache.close_index()
@@ -0,0 +1,89 @@
+import struct
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import gmail_analyzer
+from gmail_analyzer import ProcessedIdSet
+
+IDS = [f"{0x18c0000000000000 + i * 7919:x}" for i in range(10)]
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / 'processed_ids.bin'), str(tmp_path / 'processed_ids.new')
+
+
+def test_base_file_is_a_header_and_sorted_little_endian_ids(paths):
+    base, _ = paths
+    values = sorted(int(msg_id, 16) for msg_id in IDS)
+    ProcessedIdSet.write_base(base, values[:1] + values)
+
+    data = Path(base).read_bytes()
+    header = gmail_analyzer.IDS_HEADER
+    assert header.unpack(data[:header.size]) == (gmail_analyzer.IDS_MAGIC,
+                                                 gmail_analyzer.IDS_VERSION, len(values))
+    assert list(struct.unpack(f"<{len(values)}Q", data[header.size:])) == values
+
+
+def test_new_ids_go_to_the_sidecar_and_survive_a_torn_append(paths):
+    base, sidecar = paths
+    processed_ids = ProcessedIdSet.open(base, sidecar)
+    for msg_id in IDS[:3]:
+        processed_ids.add(msg_id)
+    processed_ids.add(IDS[0])
+    processed_ids.save(compact=False)
+    processed_ids.close()
+
+    assert Path(sidecar).read_bytes() == struct.pack('<3Q', *(int(i, 16) for i in IDS[:3]))
+    with open(sidecar, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    processed_ids = ProcessedIdSet.open(base, sidecar)
+    assert len(processed_ids) == 3
+    assert all(msg_id in processed_ids for msg_id in IDS[:3])
+    assert IDS[3] not in processed_ids
+    assert 'not-hex' not in processed_ids
+    processed_ids.close()
+
+
+def test_compact_merges_the_sidecar_into_the_base(paths):
+    base, sidecar = paths
+    ProcessedIdSet.write_base(base, sorted(int(msg_id, 16) for msg_id in IDS[:5]))
+    processed_ids = ProcessedIdSet.open(base, sidecar)
+    for msg_id in IDS[5:]:
+        processed_ids.add(msg_id)
+    processed_ids.save(compact=False)
+
+    processed_ids.compact()
+
+    assert Path(sidecar).stat().st_size == 0
+    assert sorted(processed_ids) == sorted(IDS)
+    processed_ids.close()
+    processed_ids = ProcessedIdSet.open(base, sidecar)
+    assert len(processed_ids) == len(IDS)
+    assert all(msg_id in processed_ids for msg_id in IDS)
+    processed_ids.close()
+
+
+def test_save_compacts_once_the_sidecar_is_large(paths, monkeypatch):
+    base, sidecar = paths
+    monkeypatch.setattr(gmail_analyzer, 'IDS_SIDECAR_LIMIT', 4)
+    processed_ids = ProcessedIdSet.open(base, sidecar)
+    for msg_id in IDS[:4]:
+        processed_ids.add(msg_id)
+    processed_ids.save()
+
+    assert Path(sidecar).stat().st_size == 0
+    assert len(processed_ids.base) == 4 and not processed_ids.buffer
+    processed_ids.close()
+
+
+def test_open_rejects_a_base_file_that_does_not_match_its_header(paths):
+    base, sidecar = paths
+    ProcessedIdSet.write_base(base, [1, 2, 3])
+    with open(base, 'ab') as f:
+        f.write(b'\0' * 4)
+    with pytest.raises(ValueError):
+        ProcessedIdSet.open(base, sidecar)